@@ -0,0 +1,320 @@
+'''Delivery of compiled messages over SMTP and LMTP
+
+Messages are submitted to a `Deliverer` which keeps a bounded queue of
+messages and a pool of connections reused between messages. When the server
+supports PIPELINING the envelope commands of a message are sent in one go.
+The result of a delivery is a list of `Result`, one for each recipient.
+'''
+import asyncio
+import logging
+import socket
+import email.utils
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+Result = namedtuple('Result', ('recipient', 'code', 'message'))
+
+default_ports = {
+    'smtp': 25,
+    'lmtp': 24
+}
+
+
+class DeliveryError(Exception):
+    def __init__(self, code, message):
+        Exception.__init__(self, '%s %s' % (code, message))
+        self.code = code
+        self.message = message
+
+
+def parse_url(url):
+    '''Parse a url like smtp://host:port or lmtp:///path/to/socket
+
+    Returns a tuple (protocol, host, port) where port is None for a unix
+    socket with the path in host.
+    '''
+    protocol, sep, address = url.partition('://')
+    if not sep or protocol not in default_ports:
+        raise ValueError('Unsupported delivery url %r' % url)
+    if address.startswith('/'):
+        return protocol, address, None
+    host, sep, port = address.rpartition(':')
+    if not sep:
+        return protocol, address, default_ports[protocol]
+    return protocol, host, int(port)
+
+
+def envelope(message):
+    '''Get the sender and recipients of a message from its headers'''
+    sender = email.utils.parseaddr(message.get('From', ''))[1]
+    fields = []
+    for header in ('To', 'Cc', 'Bcc'):
+        fields.extend(message.get_all(header, []))
+    recipients = []
+    seen = set()
+    for name, address in email.utils.getaddresses(fields):
+        if address and address not in seen:
+            seen.add(address)
+            recipients.append(address)
+    return sender, recipients
+
+
+def strip_bcc(data):
+    '''Remove the Bcc fields from the header of the message `data` (bytes)
+
+    Like `sendmail -t` the recipients are taken from the header by `envelope`
+    but the blind copies must not show in the message delivered.
+    '''
+    lines = data.splitlines(True)
+    out = []
+    bcc = False
+    for i, line in enumerate(lines):
+        if line in (b'\n', b'\r\n'):
+            out.extend(lines[i:])
+            break
+        if line[:1] not in (b' ', b'\t'):
+            bcc = line.split(b':', 1)[0].strip().lower() == b'bcc'
+        if not bcc:
+            out.append(line)
+    return b''.join(out)
+
+
+def _transparent(data):
+    '''Normalise line endings to CRLF and apply dot stuffing'''
+    data = data.replace(b'\r\n', b'\n').replace(b'\n', b'\r\n')
+    if data.startswith(b'.'):
+        data = b'.' + data
+    data = data.replace(b'\r\n.', b'\r\n..')
+    if not data.endswith(b'\r\n'):
+        data += b'\r\n'
+    return data + b'.\r\n'
+
+
+class Connection(object):
+    '''A SMTP or LMTP client connection'''
+
+    def __init__(self, protocol='smtp', hostname=None):
+        self.lmtp = protocol == 'lmtp'
+        self.hostname = hostname or socket.getfqdn()
+        self.extensions = set()
+        self._reader = None
+        self._writer = None
+
+    @property
+    def closed(self):
+        return self._writer is None or self._reader.at_eof()
+
+    async def connect(self, host, port=None):
+        logger.debug('connecting to %s:%s', host, port)
+        if port is None:
+            self._reader, self._writer = await asyncio.open_unix_connection(host)
+        else:
+            self._reader, self._writer = await asyncio.open_connection(host, port)
+        await self._expect(220)
+        await self._hello()
+
+    async def _reply(self):
+        lines = []
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                self.close()
+                raise DeliveryError(421, 'Connection closed by server')
+            line = line.rstrip(b'\r\n').decode('utf-8', 'replace')
+            lines.append(line[4:])
+            if line[3:4] != '-':
+                return int(line[:3]), '\n'.join(lines)
+
+    async def _expect(self, code):
+        reply_code, message = await self._reply()
+        if reply_code != code:
+            raise DeliveryError(reply_code, message)
+        return message
+
+    async def _command(self, command):
+        self._writer.write(command.encode('utf-8') + b'\r\n')
+        await self._writer.drain()
+        return await self._reply()
+
+    async def _hello(self):
+        code, message = await self._command(
+            '%s %s' % ('LHLO' if self.lmtp else 'EHLO', self.hostname))
+        if code != 250 and not self.lmtp:
+            code, message = await self._command('HELO %s' % self.hostname)
+        if code != 250:
+            raise DeliveryError(code, message)
+        self.extensions = set(
+            line.split()[0].upper() for line in message.split('\n')[1:] if line.strip())
+
+    async def send(self, sender, recipients, data):
+        '''Send the message `data` (bytes) returning a list of `Result`'''
+        commands = ['MAIL FROM:<%s>' % sender]
+        commands.extend('RCPT TO:<%s>' % r for r in recipients)
+        commands.append('DATA')
+
+        if 'PIPELINING' in self.extensions:
+            self._writer.write(b''.join(c.encode('utf-8') + b'\r\n' for c in commands))
+            await self._writer.drain()
+            replies = [await self._reply() for _ in commands]
+        else:
+            replies = []
+            for command in commands:
+                replies.append(await self._command(command))
+                if command == commands[0] and replies[0][0] != 250:
+                    break
+            replies.extend([replies[0]] * (len(commands) - len(replies)))
+
+        mail_reply, rcpt_replies, data_reply = replies[0], replies[1:-1], replies[-1]
+        accepted = [r for r, (code, _) in zip(recipients, rcpt_replies) if code // 100 == 2]
+
+        if mail_reply[0] != 250 or data_reply[0] != 354:
+            await self.reset()
+            return [
+                Result(r, code, message) if code // 100 != 2 else Result(r, *data_reply)
+                for r, (code, message) in zip(recipients, rcpt_replies)
+            ]
+
+        self._writer.write(_transparent(data))
+        await self._writer.drain()
+
+        data_replies = {}
+        for r in accepted:
+            if self.lmtp or not data_replies:
+                reply = await self._reply()
+            data_replies[r] = reply
+
+        return [
+            Result(r, *data_replies.get(r, reply))
+            for r, reply in zip(recipients, rcpt_replies)
+        ]
+
+    async def reset(self):
+        await self._command('RSET')
+
+    async def quit(self):
+        if not self.closed:
+            try:
+                await self._command('QUIT')
+            except (DeliveryError, IOError, OSError):
+                pass
+        self.close()
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+
+class Pool(object):
+    '''A pool of at most `size` connections to the server at `url`'''
+
+    def __init__(self, url, size=4, hostname=None):
+        self._protocol, self._host, self._port = parse_url(url)
+        self._hostname = hostname
+        self._idle = []
+        self._available = asyncio.Semaphore(size)
+        self.connections = 0
+
+    async def acquire(self):
+        await self._available.acquire()
+        while self._idle:
+            connection = self._idle.pop()
+            if not connection.closed:
+                return connection
+
+        connection = Connection(self._protocol, self._hostname)
+        try:
+            await connection.connect(self._host, self._port)
+        except BaseException:
+            connection.close()
+            self._available.release()
+            raise
+        self.connections += 1
+        return connection
+
+    def release(self, connection, reuse=True):
+        if reuse and not connection.closed:
+            self._idle.append(connection)
+        else:
+            connection.close()
+        self._available.release()
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            await connection.quit()
+
+
+class Deliverer(object):
+    '''Deliver messages through a bounded queue and a connection pool
+
+    Use as an async context manager, `submit` waits while the queue is full
+    and returns a future for the list of `Result` of the message.
+    '''
+
+    def __init__(self, url, connections=4, queue_size=64, hostname=None):
+        self._pool = Pool(url, connections, hostname)
+        self._queue = asyncio.Queue(queue_size)
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(connections)]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def submit(self, sender, recipients, data):
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((sender, recipients, data, future))
+        return future
+
+    async def _work(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            sender, recipients, data, future = item
+            try:
+                connection = await self._pool.acquire()
+            except Exception as e:
+                future.set_exception(e)
+                continue
+
+            try:
+                results = await connection.send(sender, recipients, data)
+            except Exception as e:
+                logger.debug('delivery failed', exc_info=True)
+                self._pool.release(connection, reuse=False)
+                future.set_exception(e)
+            else:
+                self._pool.release(connection)
+                future.set_result(results)
+
+    async def close(self):
+        for _ in self._workers:
+            await self._queue.put(None)
+        await asyncio.gather(*self._workers)
+        await self._pool.close()
+
+    @property
+    def connections(self):
+        '''Number of connections opened'''
+        return self._pool.connections
+
+
+async def deliver_all(url, messages, connections=4, queue_size=64):
+    '''Deliver (sender, recipients, data) tuples from `messages`
+
+    Returns a list with the list of `Result` or the exception raised for each
+    message, in order.
+    '''
+    futures = []
+    async with Deliverer(url, connections, queue_size) as deliverer:
+        for sender, recipients, data in messages:
+            futures.append(await deliverer.submit(sender, recipients, data))
+    return await asyncio.gather(*futures, return_exceptions=True)
+
+
+def deliver(url, messages, connections=4, queue_size=64):
+    return asyncio.run(deliver_all(url, messages, connections, queue_size))
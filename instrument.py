@@ -0,0 +1,75 @@
+'''Counters and timings of the mailbox load pipeline
+
+The stages record into the module level `stats`
+
+    with instrument.stats.time('thread'):
+        ...
+    instrument.stats.count('stub.hit')
+
+`Stats.report` returns everything recorded as a dict and `Stats.dump` writes
+it as JSON. post dumps the stats of each loaded mailbox to the file named by
+$POST_STATS when set and resets them after, so the stats of the first
+mailbox include the header cache load at start up.
+'''
+import json
+import time
+import functools
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Stats(object):
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = defaultdict(int)
+        # Mapping name -> [calls, total seconds, longest seconds]
+        self.timers = {}
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def add_time(self, name, seconds):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def time(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def report(self):
+        return {
+            'counters': dict(self.counters),
+            'timers': dict(
+                (name, {'calls': calls, 'total': total, 'max': longest})
+                for name, (calls, total, longest) in self.timers.items()
+            )
+        }
+
+    def dump(self, fp):
+        json.dump(self.report(), fp, indent=2, sort_keys=True)
+        fp.write('\n')
+
+
+stats = Stats()
+
+
+def timed(name):
+    '''Decorator recording the time of each call in `stats` under `name`'''
+    def decorator(fun):
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            with stats.time(name):
+                return fun(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,7 +1,19 @@
 import os.path
+import re
 import logging
 import mailbox
-from collections import defaultdict, namedtuple
+import email.errors
+import email.header
+import email.parser
+import email.utils
+import sqlite3
+import time
+import zlib
+from array import array
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from instrument import stats, timed
 
 try:
     import cPickle as pickle
@@ -21,6 +33,23 @@ class Cache(object):
 
     The cache also maintains a index from Message-Id to possible `pathspec`s
     and from `pathspec` to it's Message-Id
+
+    The cache is stored in a SQLite database, `save` only writes the entries
+    changed since the cache was loaded or last saved. Loading only opens the
+    database, records and mappings are read the first time they are used.
+
+    Several processes may use the same cache, each `save` merges the changed
+    entries into the database in one transaction and entries saved by other
+    processes are seen on the next miss, or after `refresh`. Records saved
+before a header was added to `headers` are misses, so they are read again.
+
+    The number of messages stored can be bounded by `max_messages` and their
+    age since last used by `max_age` (in seconds), the least recently used
+    messages are evicted on `save`. `gc` drops the pathspecs of messages no
+    longer on disk.
+
+    With `indexed` set the From address, subject words and Date of the saved
+    messages are indexed as well, for `search`.
     '''
 
     # pathspec constructor
@@ -32,23 +61,281 @@ class Cache(object):
         'From',
         'Subject',
         'References',
-        'In-Reply-To'
+        'In-Reply-To',
+        'Date'
     )
 
-    def __init__(self, cache):
+    def __init__(self, cache, max_messages=None, max_age=None, indexed=False):
         self._cache_path = os.path.abspath(cache)
-        # Mapping Message-Id -> list of tuple with (Header, Value)
-        self._cache = {}
-        # Mapping pathspec -> Message-Id
-        self._resolve = {}
-        # Mapping Message-Id -> list of pathspec
-        self._index = defaultdict(set)
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.indexed = indexed
+        # Interned Message-Ids, the number of a Message-Id is used in place of
+        # the string in all the other mappings
+        self._message_ids = []
+        self._numbers = {}
+        # Numbers of the messages evicted, reused for new Message-Ids
+        self._free = []
+        # Mapping number -> tuple with the value, or None, of each header in
+        # `headers`, None when the headers of the message are not cached
+        self._records = []
+        # Mapping number -> _RECORD and _PATHS flags set when the record and
+        # the pathspecs of the message have been read from the database, and
+        # _STALE when the time the record was last used must be updated
+        self._fetched = bytearray()
+        # Numbers of the stale records used since the last save
+        self._used = set()
+        # Pathspecs are split in a group, the provider and the first item of
+        # the spec (the path of a maildir), and the rest (the maildir key).
+        # Mapping group number -> (provider, first item)
+        self._groups = []
+        self._group_numbers = {}
+        # Mapping group number -> rest of the pathspec -> number
+        self._resolve = []
+        # Mapping number -> group number of its pathspec, -1 for no pathspec
+        # and -2 when there are several
+        self._path_group = array('i')
+        # Mapping number -> rest of its pathspec, or a tuple of (group, rest)
+        # when there are several
+        self._path_rest = []
+        # Values of headers commonly repeated between messages
+        self._shared = {}
+        # Mapping maildir path -> (mtimes, keys) of the last listing
+        self._snapshots = {}
+        # Numbers, pathspecs and snapshots changed since last save
+        self._dirty_messages = set()
+        self._dirty_paths = set()
+        self._deleted_paths = set()
+        self._dirty_snapshots = set()
+        self._db = None
+        self._legacy = False
+
+    def _number(self, message_id):
+        '''Get the number of a Message-Id, adding it if new'''
+        try:
+            return self._numbers[message_id]
+        except KeyError:
+            if self._free:
+                number = self._free.pop()
+                self._message_ids[number] = message_id
+            else:
+                number = len(self._message_ids)
+                self._message_ids.append(message_id)
+                self._records.append(None)
+                self._fetched.append(0)
+                self._path_group.append(-1)
+                self._path_rest.append(None)
+            self._numbers[message_id] = number
+            return number
+
+    def _forget(self, message_ids):
+        '''Drop the messages deleted from the database from memory'''
+        for message_id in message_ids:
+            number = self._numbers.pop(_decode_id(message_id), None)
+            if number is None:
+                continue
+            for key in self._paths(number):
+                group, rest = self._split_key(key)
+                if self._resolve[group].get(rest) == number:
+                    del self._resolve[group][rest]
+            self._message_ids[number] = None
+            self._records[number] = None
+            self._fetched[number] = 0
+            self._used.discard(number)
+            self._path_group[number] = -1
+            self._path_rest[number] = None
+            self._free.append(number)
+        # Keep only the values still used by a record
+        index = self.headers.index('From')
+        self._shared = dict(
+            (record[index], record[index]) for record in self._records
+            if record is not None and type(record[index]) is str)
+
+    def _split_key(self, key, create=False):
+        '''Split a pathspec in group number and rest
+
+        The group number is None if the group is not known and `create` is
+        not set.
+        '''
+        provider, spec = key
+        if type(spec) is tuple and len(spec) == 2:
+            group, rest = (provider, spec[0]), spec[1]
+        else:
+            group, rest = (provider, None), spec
+        number = self._group_numbers.get(group)
+        if number is None and create:
+            number = len(self._groups)
+            self._groups.append(group)
+            self._group_numbers[group] = number
+            self._resolve.append({})
+        return number, rest
+
+    def _join_key(self, group, rest):
+        provider, first = self._groups[group]
+        if first is None:
+            return (provider, rest)
+        return (provider, (first, rest))
+
+    def _resolve_key(self, key):
+        '''Get the number of the message at pathspec `key`'''
+        group, rest = self._split_key(key)
+        if group is not None:
+            number = self._resolve[group].get(rest)
+            if number is not None:
+                return number
+        key = tuple(key)
+        if key in self._deleted_paths:
+            raise KeyError(key)
+        row = self._query(
+            'SELECT message_id FROM resolve WHERE provider = ? AND spec = ?',
+            (key[0], _dumps(key[1])))
+        if row is None:
+            raise KeyError(key)
+        number = self._number(_decode_id(row[0]))
+        self._add_path(key, number)
+        return number
+
+    def _paths(self, number):
+        group = self._path_group[number]
+        if group == -1:
+            return ()
+        if group == -2:
+            return tuple(self._join_key(g, r) for g, r in self._path_rest[number])
+        return (self._join_key(group, self._path_rest[number]),)
+
+    def _add_path(self, key, number):
+        '''Map the pathspec `key` to the message `number`'''
+        group, rest = self._split_key(key, create=True)
+        old = self._resolve[group].get(rest)
+        if old == number:
+            return
+        if old is not None:
+            self._remove_path(old, group, rest)
+        self._resolve[group][rest] = number
+
+        current = self._path_group[number]
+        if current == -1:
+            self._path_group[number] = group
+            self._path_rest[number] = rest
+        elif current == -2:
+            self._path_rest[number] += ((group, rest),)
+        else:
+            self._path_group[number] = -2
+            self._path_rest[number] = ((current, self._path_rest[number]), (group, rest))
+
+    def _remove_path(self, number, group, rest):
+        current = self._path_group[number]
+        if current == -2:
+            paths = tuple(p for p in self._path_rest[number] if p != (group, rest))
+            if len(paths) == 1:
+                self._path_group[number], self._path_rest[number] = paths[0]
+            else:
+                self._path_rest[number] = paths
+        elif current == group and self._path_rest[number] == rest:
+            self._path_group[number] = -1
+            self._path_rest[number] = None
+
+    def _make_record(self, number, get):
+        '''Build the record of a message, `get` returns the value of a header'''
+        values = []
+        for header in self.headers:
+            value = get(header)
+            if header == 'Message-Id' and value is not None:
+                value = self._message_ids[number]
+            # Headers with raw 8-bit bytes are `email.header.Header`, which
+            # cannot be hashed, only plain strings are interned
+            elif header == 'In-Reply-To' and type(value) is str and value in self._numbers:
+                value = self._message_ids[self._numbers[value]]
+            elif header == 'From' and type(value) is str:
+                value = self._shared.setdefault(value, value)
+            values.append(value)
+        return tuple(values)
+
+    def _query(self, sql, args):
+        '''Get the first row of a query, None if there is no database'''
+        if self._db is None or self._legacy:
+            return None
+        return self._db.execute(sql, args).fetchone()
+
+    def _fetch_record(self, number, row=None):
+        '''Read the record of message `number` unless already done
+
+        `row` is the (headers, used) of the message when already queried.
+        '''
+        if self._fetched[number] & _RECORD:
+            return
+        if row is None:
+            row = self._query('SELECT headers, used FROM message WHERE message_id = ?',
+                              (_encode_id(self._message_ids[number]),))
+            if row is None:
+                # Not remembered, another process may add it later
+                return
+        headers, used = row
+        self._fetched[number] |= _RECORD
+        # The time of use is only needed to evict, and only updated when off
+        # by more than `_used_resolution` so reading does not mean writing
+        if ((self.max_messages is not None or self.max_age is not None) and
+                used < time.time() - _used_resolution):
+            self._fetched[number] |= _STALE
+        stats.count('cache.read.bytes', len(headers))
+        items = dict(pickle.loads(headers))
+        if not self._complete(items):
+            # Saved before a header was added, read the message again
+            stats.count('cache.stale')
+            return
+        self._records[number] = self._make_record(number, items.get)
+
+    def _fetch_paths(self, number):
+        '''Read the pathspecs of message `number` unless already done'''
+        if self._fetched[number] & _PATHS:
+            return
+        self._fetched[number] |= _PATHS
+        if self._db is None or self._legacy:
+            return
+        for provider, spec in self._db.execute(
+                'SELECT provider, spec FROM resolve WHERE message_id = ?',
+                (_encode_id(self._message_ids[number]),)):
+            key = (provider, pickle.loads(spec))
+            group, rest = self._split_key(key)
+            # Pathspecs changed since the last save take precedence
+            if group is not None and rest in self._resolve[group]:
+                continue
+            if key not in self._deleted_paths:
+                self._add_path(key, number)
 
     def __getitem__(self, key):
         '''Get cached headers by Message-Id or pathspec'''
         if isinstance(key, tuple):
-            key = self._resolve[key]
-        return self._cache[key]
+            number = self._resolve_key(key)
+            self._fetch_record(number)
+        else:
+            number = self._numbers.get(key)
+            if number is not None:
+                self._fetch_record(number)
+            else:
+                row = self._query('SELECT headers, used FROM message WHERE message_id = ?',
+                                  (_encode_id(key),))
+                if row is None:
+                    raise KeyError(key)
+                number = self._number(key)
+                self._fetch_record(number, row)
+        record = self._records[number]
+        if record is None:
+            raise KeyError(key)
+        if self._fetched[number] & _STALE:
+            self._fetched[number] &= ~_STALE
+            self._used.add(number)
+        return self._items(record)
+
+    def _items(self, record):
+        return [(h, v) for h, v in zip(self.headers, record) if v is not None]
+
+    def _complete(self, items):
+        '''Check if the saved headers `items` has all the `headers` cached
+
+        Headers missing from the message are saved as None.
+        '''
+        return all(header in items for header in self.headers)
 
     # Should this perhaps be renamed to .cache()
     # cache[key] = x; x' = cache[key]; x == x' does not hold
@@ -62,48 +349,475 @@ class Cache(object):
         if `key` is a pathspec a entry in the index will be made as well
         '''
         message_id = value['Message-Id']
+        number = self._number(message_id)
         if isinstance(key, tuple):
             if len(key) != 2:
                 raise TypeError('Tuple of size 2 expected got %s %r' % (len(key), key))
             key = tuple(key)
-            self._resolve[key] = message_id
-            self._index[message_id].add(key)
-        elif messageId != key:
+            self._add_path(key, number)
+            self._dirty_paths.add(key)
+            self._deleted_paths.discard(key)
+        elif message_id != key:
             raise Exception('message id mismatch')
-        slim = [(k, value[k]) for k in self.headers if k in value]
-        self._cache[message_id] = slim
+        self._records[number] = self._make_record(
+            number, lambda k: value[k] if k in value else None)
+        self._fetched[number] |= _RECORD
+        self._dirty_messages.add(number)
+
+    def __delitem__(self, key):
+        '''Remove the pathspec `key` from the cache'''
+        number = self._resolve_key(key)
+        group, rest = self._split_key(key)
+        del self._resolve[group][rest]
+        self._remove_path(number, group, rest)
+        key = tuple(key)
+        self._dirty_paths.discard(key)
+        self._deleted_paths.add(key)
+
+    def snapshot(self, path):
+        '''Get the (mtimes, keys) stored for the maildir at `path`, or None'''
+        if path not in self._snapshots:
+            row = self._query('SELECT mtimes, keys FROM snapshot WHERE path = ?', (path,))
+            if row is None:
+                return None
+            mtimes, keys = row
+            keys = zlib.decompress(keys).decode('utf-8', 'surrogateescape')
+            self._snapshots[path] = (
+                tuple(int(m) for m in mtimes.split()),
+                tuple(keys.split('\n')) if keys else ()
+            )
+        return self._snapshots[path]
+
+    def set_snapshot(self, path, mtimes, keys):
+        '''Store the directory `mtimes` and `keys` of the maildir at `path`'''
+        self._snapshots[path] = (tuple(mtimes), tuple(keys))
+        self._dirty_snapshots.add(path)
+
+    def refresh(self):
+        '''Read the pathspecs saved by other processes again when used'''
+        for number, flags in enumerate(self._fetched):
+            if flags & _PATHS:
+                self._fetched[number] = flags & ~_PATHS
 
     def lookup(self, message_id):
         '''Get a list of `pathspec`s providing the message with the given id'''
-        return self._index[message_id]
+        if not isinstance(message_id, str):
+            raise KeyError(message_id)
+        number = self._numbers.get(message_id)
+        if number is None:
+            if self._query('SELECT 1 FROM resolve WHERE message_id = ?',
+                           (_encode_id(message_id),)) is None:
+                return set()
+            number = self._number(message_id)
+        self._fetch_paths(number)
+        return set(self._paths(number))
 
-    def load(self):
-        '''Unserialise cache'''
-        logger.debug('loading header cache')
+    def _connect(self):
+        if self._db is None:
+            dir = os.path.dirname(self._cache_path)
+            if not os.path.exists(dir):
+                os.makedirs(dir, 0o700)
+            # Wait for the writes of other processes rather than failing and
+            # take the write lock at the start of a transaction
+            self._db = sqlite3.connect(
+                self._cache_path, timeout=_lock_timeout, isolation_level='IMMEDIATE')
+            os.chmod(self._cache_path, 0o600)
+            # Readers and a writer do not block each other with a write-ahead log
+            self._db.execute('PRAGMA journal_mode = WAL')
+            # Let SQLite read the pages of the database through a mapping
+            self._db.execute('PRAGMA mmap_size = %d' % _mmap_size)
+            self._db.executescript(_schema)
+            columns = [c[1] for c in self._db.execute('PRAGMA table_info(message)')]
+            if 'used' not in columns:
+                self._db.execute(
+                    'ALTER TABLE message ADD COLUMN used INTEGER NOT NULL DEFAULT 0')
+            self._db.executescript(_indexes)
+        return self._db
+
+    def _is_legacy(self):
+        '''Check if the cache file is a pickle written by an earlier version'''
+        try:
+            with open(self._cache_path, 'rb') as f:
+                head = f.read(len(_sqlite_magic))
+        except IOError:
+            return False
+        return len(head) > 0 and head != _sqlite_magic
+
+    def _load_legacy(self):
         with open(self._cache_path, 'rb') as f:
             data = pickle.load(f)
-        self._cache.update(data['messages'])
-        self._resolve.update(data['resolve'])
-        self._index.update(data['index'])
-        logger.info('Cache contains (%d messages, %d mappings, %d path index entries)' % (
-            len(self._cache),
-            len(self._resolve),
-            len(self._index)
-        ))
+        for message_id, items in data['messages'].items():
+            number = self._number(message_id)
+            items = dict(items)
+            if self._complete(items):
+                self._records[number] = self._make_record(number, items.get)
+        for key, message_id in data['resolve'].items():
+            self._add_path(key, self._number(message_id))
+        for number in range(len(self._fetched)):
+            self._fetched[number] = _RECORD | _PATHS
+        # Everything is written to the new database on the next save
+        self._dirty_messages.update(range(len(self._records)))
+        self._dirty_paths.update(data['resolve'])
+        self._legacy = True
+
+    @timed('cache.load')
+    def load(self):
+        '''Open the cache
 
+        A pickled cache written by an earlier version is read completely,
+        otherwise only the database is opened.
+        '''
+        if self._is_legacy():
+            logger.info('converting pickled cache %s', self._cache_path)
+            self._load_legacy()
+        else:
+            logger.debug('opening header cache %s', self._cache_path)
+            self._connect()
+
+    @timed('cache.save')
     def save(self):
-        '''Serialise cache'''
-        logger.debug('saving header cache')
-        dir = os.path.dirname(self._cache_path)
-        if not os.path.exists(dir):
-            os.makedirs(dir, 0o700)
-        mode = os.O_WRONLY | os.O_CREAT
-        with os.fdopen(os.open(self._cache_path, mode, 0o600), 'wb') as f:
-            pickle.dump({
-                'messages': self._cache,
-                'resolve': self._resolve,
-                'index': self._index
-            }, f)
+        '''Serialise cache
+
+        Only the entries changed since the last save are written, in a single
+        transaction.
+        '''
+        logger.debug('saving header cache (%d messages, %d mappings changed)',
+                     len(self._dirty_messages), len(self._dirty_paths))
+        if self._legacy:
+            # Another process may have converted it already
+            if self._is_legacy():
+                os.unlink(self._cache_path)
+            self._legacy = False
+
+        now = int(time.time())
+        used = [number for number in self._used if number not in self._dirty_messages]
+        numbers = [
+            number for number in self._dirty_messages
+            if self._message_ids[number] is not None and self._records[number] is not None
+        ]
+        messages = [
+            (_encode_id(self._message_ids[number]),
+             _dumps(list(zip(self.headers, self._records[number]))), now)
+            for number in numbers
+        ]
+        stats.count('cache.save.messages', len(messages))
+        stats.count('cache.save.bytes', sum(len(m[1]) for m in messages))
+        db = self._connect()
+        with db:
+            db.executemany(
+                'INSERT OR REPLACE INTO message (message_id, headers, used) VALUES (?, ?, ?)',
+                messages
+            )
+            if self.indexed:
+                self._index(db, [
+                    (message[0], self._items(self._records[number]))
+                    for number, message in zip(numbers, messages)
+                ])
+            db.executemany(
+                'UPDATE message SET used = ? WHERE message_id = ?',
+                [(now, _encode_id(self._message_ids[number]))
+                 for number in used if self._message_ids[number] is not None]
+            )
+            db.executemany(
+                'INSERT OR REPLACE INTO resolve (provider, spec, message_id) VALUES (?, ?, ?)',
+                [(key[0], _dumps(key[1]), _encode_id(self._message_ids[number]))
+                 for key, number in ((k, self._resolve_key(k)) for k in self._dirty_paths)
+                 if self._message_ids[number] is not None]
+            )
+            db.executemany(
+                'DELETE FROM resolve WHERE provider = ? AND spec = ?',
+                [(key[0], _dumps(key[1])) for key in self._deleted_paths]
+            )
+            db.executemany(
+                'INSERT OR REPLACE INTO snapshot (path, mtimes, keys) VALUES (?, ?, ?)',
+                [(path,
+                  ' '.join(str(m) for m in self._snapshots[path][0]),
+                  sqlite3.Binary(zlib.compress(
+                      '\n'.join(self._snapshots[path][1]).encode('utf-8', 'surrogateescape'))))
+                 for path in self._dirty_snapshots]
+            )
+            evicted = self._evict(db, now)
+        self._used.clear()
+        self._dirty_messages.clear()
+        self._dirty_paths.clear()
+        self._deleted_paths.clear()
+        self._dirty_snapshots.clear()
+        if evicted:
+            self._forget(evicted)
+
+    def _evict(self, db, now):
+        '''Delete the messages over the size and age budget from the database
+
+        Returns the Message-Ids deleted, as stored.
+        '''
+        evicted = []
+        if self.max_age is not None:
+            evicted.extend(row[0] for row in db.execute(
+                'SELECT message_id FROM message WHERE used < ?', (now - self.max_age,)))
+            db.execute('DELETE FROM message WHERE used < ?', (now - self.max_age,))
+        if self.max_messages is not None:
+            over = [row[0] for row in db.execute(
+                'SELECT message_id FROM message ORDER BY used DESC LIMIT -1 OFFSET ?',
+                (self.max_messages,))]
+            db.executemany('DELETE FROM message WHERE message_id = ?',
+                           [(message_id,) for message_id in over])
+            evicted.extend(over)
+        if evicted:
+            logger.info('evicted %d messages from header cache', len(evicted))
+            db.execute('DELETE FROM resolve WHERE message_id NOT IN '
+                       '(SELECT message_id FROM message)')
+            _drop_index_orphans(db)
+        return evicted
+
+    def gc(self):
+        '''Drop the pathspecs of maildir messages no longer on disk
+
+        Messages left without a pathspec are deleted from the database as
+        well. Returns the number of pathspecs dropped.
+        '''
+        self.save()
+        db = self._connect()
+        listings = {}
+        dead = []
+        for spec, in db.execute("SELECT spec FROM resolve WHERE provider = 'maildir'"):
+            path, key = pickle.loads(spec)
+            if path not in listings:
+                listings[path] = _maildir_keys(path)
+            if key not in listings[path]:
+                dead.append(self.pathspec('maildir', (path, key)))
+        for key in dead:
+            del self[key]
+        self.save()
+        with db:
+            orphans = [row[0] for row in db.execute(
+                'SELECT message_id FROM message WHERE message_id NOT IN '
+                '(SELECT message_id FROM resolve)')]
+            db.executemany('DELETE FROM message WHERE message_id = ?',
+                           [(message_id,) for message_id in orphans])
+            _drop_index_orphans(db)
+        if orphans:
+            self._forget(orphans)
+        logger.info('dropped %d pathspecs from header cache', len(dead))
+        return len(dead)
+
+    def _index(self, db, messages):
+        '''Index the (message_id, header items) pairs in `messages`'''
+        db.executemany('DELETE FROM subject_term WHERE message_id = ?',
+                       [(m[0],) for m in messages])
+        rows, terms = [], []
+        for message_id, items in messages:
+            headers = dict(items)
+            rows.append((message_id, _address(headers.get('From')),
+                         parse_date(headers.get('Date'))))
+            terms.extend((term, message_id) for term in _terms(headers.get('Subject')))
+        db.executemany(
+            'INSERT OR REPLACE INTO header_index (message_id, address, date) VALUES (?, ?, ?)',
+            rows)
+        db.executemany(
+            'INSERT OR IGNORE INTO subject_term (term, message_id) VALUES (?, ?)', terms)
+
+    def build_index(self):
+        '''Index the saved messages not yet indexed, returns how many'''
+        if self._legacy:
+            # Everything is indexed when the converted cache is saved
+            return 0
+        db = self._connect()
+        with db:
+            messages = [
+                (message_id, pickle.loads(headers))
+                for message_id, headers in db.execute(
+                    'SELECT message_id, headers FROM message WHERE message_id NOT IN '
+                    '(SELECT message_id FROM header_index)')
+            ]
+            self._index(db, messages)
+        return len(messages)
+
+    def search(self, sender=None, subject=None, since=None, until=None):
+        '''Get the pathspecs of the saved messages matching all the criteria
+
+        `sender` is a From address, `subject` words that must all be in the
+        subject, `since` and `until` bound the Date as a unix timestamp.
+        '''
+        where, args = [], []
+        if sender is not None:
+            where.append('address = ?')
+            args.append(_address(sender))
+        for term in _terms(subject):
+            where.append('message_id IN (SELECT message_id FROM subject_term WHERE term = ?)')
+            args.append(term)
+        if since is not None:
+            where.append('date >= ?')
+            args.append(since)
+        if until is not None:
+            where.append('date < ?')
+            args.append(until)
+        sql = 'SELECT message_id FROM header_index'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        result = set()
+        if self._legacy:
+            return result
+        for message_id, in self._connect().execute(sql, args).fetchall():
+            result.update(self.lookup(_decode_id(message_id)))
+        return result
+
+
+def _drop_index_orphans(db):
+    db.execute('DELETE FROM header_index WHERE message_id NOT IN '
+               '(SELECT message_id FROM message)')
+    db.execute('DELETE FROM subject_term WHERE message_id NOT IN '
+               '(SELECT message_id FROM message)')
+
+
+def _address(value):
+    '''Get the normalised address of a From header'''
+    if value is None:
+        return None
+    address = email.utils.parseaddr(str(value))[1]
+    return address.lower() or None
+
+
+def parse_date(value):
+    '''Get the unix timestamp of a Date header, None if missing or invalid'''
+    if value is None:
+        return None
+    date = email.utils.parsedate_tz(str(value))
+    if date is None:
+        return None
+    return email.utils.mktime_tz(date)
+
+
+_reply_prefix = re.compile(r'^\s*((re|sv|aw|fwd?)(\[\d+\])?:\s*)+', re.IGNORECASE)
+_word = re.compile(r'\w+', re.UNICODE)
+
+
+def _terms(subject):
+    '''Get the set of lower case words of a subject, without reply prefixes'''
+    if subject is None:
+        return set()
+    subject = str(subject)
+    try:
+        subject = str(email.header.make_header(email.header.decode_header(subject)))
+    except (UnicodeError, LookupError, email.errors.HeaderParseError):
+        pass
+    return set(_word.findall(_reply_prefix.sub('', subject).lower()))
+
+
+def _maildir_keys(path):
+    '''Get the set of keys of the messages in the maildir at `path`'''
+    keys = set()
+    for subdir in ('new', 'cur'):
+        try:
+            names = os.listdir(os.path.join(path, subdir))
+        except OSError:
+            continue
+        keys.update(n.split(mailbox.Maildir.colon)[0] for n in names if not n.startswith('.'))
+    return keys
+
+
+def _dumps(value):
+    # A fixed protocol keeps the serialised specs stable for use as keys
+    return sqlite3.Binary(pickle.dumps(value, 2))
+
+
+def _encode_id(message_id):
+    # Headers may contain undecodable bytes as surrogates
+    return sqlite3.Binary(message_id.encode('utf-8', 'surrogateescape'))
+
+
+def _decode_id(message_id):
+    return bytes(message_id).decode('utf-8', 'surrogateescape')
+
+
+_sqlite_magic = b'SQLite format 3\0'
+
+# Flags of Cache._fetched
+_RECORD = 1
+_PATHS = 2
+_STALE = 4
+
+# Seconds the stored time a message was last used may be behind
+_used_resolution = 24 * 3600
+
+# Seconds to wait for another process holding the database lock
+_lock_timeout = 30
+
+# Bytes of the database SQLite may memory map
+_mmap_size = 256 * 1024 * 1024
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS message (
+    message_id BLOB PRIMARY KEY,
+    headers BLOB NOT NULL,
+    used INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS resolve (
+    provider TEXT NOT NULL,
+    spec BLOB NOT NULL,
+    message_id BLOB NOT NULL,
+    PRIMARY KEY (provider, spec)
+);
+CREATE TABLE IF NOT EXISTS snapshot (
+    path TEXT PRIMARY KEY,
+    mtimes TEXT NOT NULL,
+    keys BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS header_index (
+    message_id BLOB PRIMARY KEY,
+    address TEXT,
+    date INTEGER
+);
+CREATE TABLE IF NOT EXISTS subject_term (
+    term TEXT NOT NULL,
+    message_id BLOB NOT NULL,
+    PRIMARY KEY (term, message_id)
+) WITHOUT ROWID;
+'''
+
+_indexes = '''
+CREATE INDEX IF NOT EXISTS resolve_message_id ON resolve (message_id);
+CREATE INDEX IF NOT EXISTS message_used ON message (used);
+CREATE INDEX IF NOT EXISTS header_index_address ON header_index (address);
+CREATE INDEX IF NOT EXISTS header_index_date ON header_index (date);
+CREATE INDEX IF NOT EXISTS subject_term_message_id ON subject_term (message_id);
+'''
+
+
+# Nanoseconds a directory must be older than for its mtime to be trusted
+_mtime_resolution = 2 * 10 ** 9
+
+
+def _maildir_mtimes(path):
+    '''Get the modification times of new/ and cur/ in a maildir, or None'''
+    try:
+        return tuple(os.stat(os.path.join(path, d)).st_mtime_ns for d in ('new', 'cur'))
+    except OSError:
+        return None
+
+
+# Bytes read at a time, and at most, looking for the end of the headers
+_HEADER_BLOCK = 8192
+_MAX_HEADERS = 256 * 1024
+
+
+def read_headers(path):
+    '''Parse the header block of the message at `path`, None if it is gone'''
+    if path is None:
+        return None
+    head = b''
+    try:
+        with open(path, 'rb') as f:
+            while len(head) < _MAX_HEADERS:
+                data = f.read(_HEADER_BLOCK)
+                # Search from a bit before the new data for a split separator
+                start = max(0, len(head) - 3)
+                head += data
+                if not data or b'\n\n' in head[start:] or b'\n\r\n' in head[start:]:
+                    break
+    except (IOError, OSError):
+        return None
+    return email.parser.BytesParser(mailbox.Message).parsebytes(head, headersonly=True)
 
 
 class StubFactory(object):
@@ -116,7 +830,10 @@ class StubFactory(object):
             headers = self._cache[self._mailbox.cache_key(key)]
         except KeyError:
             logger.debug('cache miss')
-            return self._mailbox[key]
+            stats.count('stub.miss')
+            with stats.time('stub.miss'):
+                return self._mailbox[key]
+        stats.count('stub.hit')
         msg = mailbox.Message()
         msg._headers = headers
         return msg
@@ -125,16 +842,107 @@ class StubFactory(object):
         self._cache[self._mailbox.cache_key(key)] = value
 
     def keys(self):
-        return self._mailbox.keys()
+        return self.scan()[0]
 
-    def __iter__(self):
-        for key in self.keys():
+    @timed('list')
+    def scan(self):
+        '''List the keys of the mailbox, returns (keys, added, removed)
+
+        For a maildir the modification times of new/ and cur/ are compared
+        to the snapshot stored in the cache, when unchanged the keys are
+        taken from the snapshot without listing the directories. Otherwise
+        the keys added and removed since the snapshot are returned, and the
+        removed ones dropped from the cache. Maildir keys do not include the
+        flags so a message changing flags is neither added nor removed.
+        '''
+        path = getattr(self._mailbox, '_path', None)
+        mtimes = _maildir_mtimes(path) if path is not None else None
+        if mtimes is None:
+            return list(self._mailbox.keys()), (), ()
+
+        snapshot = self._cache.snapshot(path)
+        if snapshot is not None and snapshot[0] == mtimes:
+            logger.debug('%s unchanged since last scan', path)
+            stats.count('list.unchanged')
+            return list(snapshot[1]), (), ()
+
+        keys = self._mailbox.keys()
+        if snapshot is None:
+            added, removed = keys, ()
+        else:
+            old = set(snapshot[1])
+            added = [k for k in keys if k not in old]
+            removed = old.difference(keys)
+        logger.debug('%s has %d new and %d removed messages',
+                     path, len(added), len(removed))
+        stats.count('list.added', len(added))
+        stats.count('list.removed', len(removed))
+
+        for key in removed:
+            try:
+                del self._cache[self._mailbox.cache_key(key)]
+            except KeyError:
+                pass
+
+        # A change within the same clock tick as the listing would not change
+        # the mtime, so only trust a snapshot of directories older than that
+        if all(m < time.time() * 1e9 - _mtime_resolution for m in mtimes):
+            self._cache.set_snapshot(path, mtimes, keys)
+        return keys, added, removed
+
+    @timed('warm')
+    def warm(self, keys=None, workers=8):
+        '''Cache the headers of the messages in `keys` missing from the cache
+
+        Only the header block of each message is read, with the files read
+        by a pool of `workers` threads. Returns the number of messages added.
+        '''
+        if keys is None:
+            keys = self.keys()
+        misses = []
+        for key in keys:
+            try:
+                self._cache[self._mailbox.cache_key(key)]
+            except KeyError:
+                misses.append(key)
+        if not misses:
+            return 0
+
+        logger.debug('reading headers of %d messages', len(misses))
+        paths = []
+        for key in misses:
+            try:
+                paths.append(os.path.join(self._mailbox._path, self._mailbox._lookup(key)))
+            except KeyError:
+                paths.append(None)
+        with ThreadPoolExecutor(workers) as executor:
+            messages = list(executor.map(read_headers, paths))
+
+        count = 0
+        for key, message in zip(misses, messages):
+            if message is not None:
+                self._cache[self._mailbox.cache_key(key)] = message
+                count += 1
+        stats.count('warm.messages', count)
+        return count
+
+    def values(self, keys=None):
+        '''Iterate the messages of `keys`, listed from the mailbox when None
+
+        Pass the keys given to `warm` to not list the mailbox again.
+        '''
+        if keys is None:
+            keys = self.keys()
+        for key in keys:
             try:
                 value = self[key]
             except KeyError:
                 continue
             yield value
 
+    def __iter__(self):
+        return self.values()
+
     def load(self):
         self._cache.load()
 
@@ -143,11 +951,16 @@ class StubFactory(object):
 
 
 class HeaderUpdaterMixin(object):
+    # A fulltext.FullTextIndex the bodies of the messages read are added to
+    fulltext = None
+
     def cache_key(self, key):
         return Cache.pathspec('maildir', (self._path, key))
 
     def _update_cache(self, key, message):
         self.header_cache[self.cache_key(key)] = message
+        if self.fulltext is not None:
+            self.fulltext.add(self.cache_key(key), message)
 
     def __setitem__(self, key, message):
         super(HeaderUpdaterMixin, self).__getitem__(key, message)
@@ -0,0 +1,340 @@
+'''Full-text index of message bodies
+
+The decoded text/* parts of messages are indexed by the same pathspecs as the
+header cache. Each word maps to a postings list of the documents containing it
+and the positions of the word in them, stored as delta encoded varints in
+blocks of about `block_size` documents. Documents are indexed in memory and
+written on `save`, which only rewrites the last block of each word; searches
+only decode the blocks that can hold a matching document.
+
+    index = FullTextIndex(path)
+    index.add(Cache.pathspec('maildir', (path, key)), message)
+    index.save()
+    index.search('lunch "next friday"')
+'''
+import os.path
+import re
+import bisect
+import logging
+import sqlite3
+
+from . import _dumps, _lock_timeout
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+logger = logging.getLogger(__name__)
+
+_word = re.compile(r'\w+', re.UNICODE)
+_tag = re.compile(r'<[^>]*>')
+_query = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def encode_varints(numbers, out):
+    '''Append `numbers` to the bytearray `out` as LEB128 varints'''
+    for n in numbers:
+        while n >= 0x80:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+    return out
+
+
+def decode_varints(data):
+    '''Iterate the varints in `data`'''
+    n = shift = 0
+    for byte in bytearray(data):
+        n |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            yield n
+            n = shift = 0
+
+
+def decode_postings(data, postings=None):
+    '''Get a mapping document -> list of positions from a postings list'''
+    if postings is None:
+        postings = {}
+    numbers = decode_varints(data)
+    document = 0
+    for delta in numbers:
+        document += delta
+        position = 0
+        positions = []
+        for _ in range(next(numbers)):
+            position += next(numbers)
+            positions.append(position)
+        postings[document] = positions
+    return postings
+
+
+def words(text):
+    '''Get the lower case words of `text`'''
+    return _word.findall(text.lower())
+
+
+def message_text(message):
+    '''Get the decoded text of the text/* parts of `message`'''
+    texts = []
+    for part in message.walk():
+        if part.get_content_maintype() != 'text':
+            continue
+        payload = part.get_payload(decode=True)
+        if payload is None:
+            continue
+        charset = part.get_content_charset() or 'us-ascii'
+        try:
+            text = payload.decode(charset, 'replace')
+        except LookupError:
+            text = payload.decode('latin-1')
+        if part.get_content_subtype() == 'html':
+            text = _tag.sub(' ', text)
+        texts.append(text)
+    return '\n'.join(texts)
+
+
+class FullTextIndex(object):
+    '''An incremental full-text index stored in a SQLite database at `path`'''
+
+    # Documents indexed in memory before they are written
+    flush_size = 1000
+    # Documents of a word in a block before a new block is started
+    block_size = 256
+
+    def __init__(self, path):
+        self._path = os.path.abspath(path)
+        self._db = None
+        # Mapping pathspec -> number of the documents not yet saved, in order
+        self._pending_keys = {}
+        # Mapping word -> [first document, last document, documents, bytearray]
+        # of the postings not yet saved, without the first document
+        self._pending = {}
+
+    def _connect(self):
+        if self._db is None:
+            dir = os.path.dirname(self._path)
+            if not os.path.exists(dir):
+                os.makedirs(dir, 0o700)
+            self._db = sqlite3.connect(
+                self._path, timeout=_lock_timeout, isolation_level='IMMEDIATE')
+            os.chmod(self._path, 0o600)
+            self._db.execute('PRAGMA journal_mode = WAL')
+            self._db.executescript(_schema)
+        return self._db
+
+    def __contains__(self, key):
+        key = (key[0], key[1])
+        if key in self._pending_keys:
+            return True
+        row = self._connect().execute(
+            'SELECT 1 FROM document WHERE provider = ? AND spec = ?',
+            (key[0], _dumps(key[1]))).fetchone()
+        return row is not None
+
+    def add(self, key, message):
+        '''Index the body of `message` under the pathspec `key`
+
+        Messages are not changed in place, so a key already indexed is skipped.
+        Returns True if the message was indexed.
+        '''
+        if key in self:
+            return False
+        # Documents are numbered from 1 in memory until saved
+        document = self._pending_keys[(key[0], key[1])] = len(self._pending_keys) + 1
+
+        positions = {}
+        for position, word in enumerate(words(message_text(message))):
+            positions.setdefault(word, []).append(position)
+        for word, found in positions.items():
+            pending = self._pending.get(word)
+            if pending is None:
+                pending = self._pending[word] = [document, document, 1, bytearray()]
+            else:
+                encode_varints((document - pending[1],), pending[3])
+                pending[1] = document
+                pending[2] += 1
+            data = pending[3]
+            encode_varints((len(found),), data)
+            encode_varints((p - q for p, q in zip(found, [0] + found)), data)
+
+        if len(self._pending_keys) >= self.flush_size:
+            self.save()
+        return True
+
+    def remove(self, key):
+        '''Drop the document at pathspec `key` from the results'''
+        self.save()
+        db = self._connect()
+        with db:
+            db.execute('DELETE FROM document WHERE provider = ? AND spec = ?',
+                       (key[0], _dumps(key[1])))
+
+    def save(self):
+        '''Write the documents indexed in memory to the database
+
+        Documents another process indexed meanwhile are left out.
+        '''
+        if not self._pending_keys:
+            return
+        logger.debug('saving postings of %d documents', len(self._pending_keys))
+        pending, self._pending = self._pending, {}
+        keys, self._pending_keys = self._pending_keys, {}
+        db = self._connect()
+        with db:
+            # Mapping number in memory -> number in the database
+            numbers = {}
+            for key, document in keys.items():
+                cursor = db.execute(
+                    'INSERT OR IGNORE INTO document (provider, spec) VALUES (?, ?)',
+                    (key[0], _dumps(key[1])))
+                if cursor.rowcount:
+                    numbers[document] = cursor.lastrowid
+            if not numbers:
+                return
+            # Numbers are never reused and the database is locked, so unless
+            # some documents were left out they follow each other
+            base = numbers[min(numbers)] - min(numbers)
+            shifted = len(numbers) == len(keys) and all(
+                number == base + document for document, number in numbers.items())
+
+            for word, (first, last, count, data) in pending.items():
+                if shifted:
+                    first, last = base + first, base + last
+                else:
+                    first, last, count, data = _renumber(first, data, numbers)
+                    if not count:
+                        continue
+                self._append(db, word, first, last, count, data)
+
+    def _append(self, db, word, first, last, count, data):
+        row = db.execute(
+            'SELECT first, last, count, postings FROM block WHERE word = ? '
+            'ORDER BY first DESC LIMIT 1', (word,)).fetchone()
+        if row is not None and row[2] < self.block_size:
+            postings = bytearray(row[3])
+            encode_varints((first - row[1],), postings)
+            postings += data
+            db.execute(
+                'UPDATE block SET last = ?, count = ?, postings = ? '
+                'WHERE word = ? AND first = ?',
+                (last, row[2] + count, sqlite3.Binary(bytes(postings)), word, row[0]))
+        else:
+            postings = encode_varints((first,), bytearray()) + data
+            db.execute(
+                'INSERT INTO block (word, first, last, count, postings) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (word, first, last, count, sqlite3.Binary(bytes(postings))))
+
+    def _count(self, word):
+        row = self._connect().execute(
+            'SELECT SUM(count) FROM block WHERE word = ?', (word,)).fetchone()
+        return row[0] or 0
+
+    def _postings(self, word, documents=None):
+        '''Get the postings of `word`, only of `documents` when given'''
+        postings = {}
+        if documents is not None:
+            documents = sorted(documents)
+        for first, last, data in self._connect().execute(
+                'SELECT first, last, postings FROM block WHERE word = ? ORDER BY first',
+                (word,)):
+            if documents is not None:
+                i = bisect.bisect_left(documents, first)
+                if i == len(documents) or documents[i] > last:
+                    continue
+            decode_postings(data, postings)
+        return postings
+
+    def search(self, query):
+        '''Get the pathspecs of the saved documents matching `query`
+
+        All the words of the query must be found, words within double quotes
+        must be found next to each other in that order.
+        '''
+        phrases = []
+        for phrase, word in _query.findall(query):
+            found = words(phrase or word)
+            if found:
+                phrases.append(found)
+        if not phrases:
+            return set()
+
+        # Intersect starting with the rarest word, decoding only the blocks
+        # of the other words holding documents still left
+        order = sorted(set(w for phrase in phrases for w in phrase), key=self._count)
+        postings = {}
+        documents = None
+        for word in order:
+            postings[word] = self._postings(word, documents)
+            if documents is None:
+                documents = set(postings[word])
+            else:
+                documents.intersection_update(postings[word])
+            if not documents:
+                return set()
+
+        for phrase in phrases:
+            if len(phrase) > 1:
+                documents = set(
+                    d for d in documents if _has_phrase([postings[w][d] for w in phrase]))
+
+        result = set()
+        db = self._connect()
+        for document in documents:
+            row = db.execute('SELECT provider, spec FROM document WHERE id = ?',
+                             (document,)).fetchone()
+            if row is not None:
+                result.add((row[0], pickle.loads(row[1])))
+        return result
+
+
+def _renumber(first, data, numbers):
+    '''Renumber pending postings by `numbers`, leaving out missing documents'''
+    postings = decode_postings(encode_varints((first,), bytearray()) + data)
+    out = bytearray()
+    first = previous = None
+    count = 0
+    for document in sorted(postings):
+        number = numbers.get(document)
+        if number is None:
+            continue
+        if first is None:
+            first = number
+        else:
+            encode_varints((number - previous,), out)
+        positions = postings[document]
+        encode_varints((len(positions),), out)
+        encode_varints((p - q for p, q in zip(positions, [0] + positions)), out)
+        previous = number
+        count += 1
+    return first, previous, count, out
+
+
+def _has_phrase(positions):
+    '''Check if there is a p with p + i in the i:th list of `positions`'''
+    rest = [set(p) for p in positions[1:]]
+    return any(
+        all(p + i in found for i, found in enumerate(rest, 1))
+        for p in positions[0]
+    )
+
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS document (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    provider TEXT NOT NULL,
+    spec BLOB NOT NULL,
+    UNIQUE (provider, spec)
+);
+CREATE TABLE IF NOT EXISTS block (
+    word TEXT NOT NULL,
+    first INTEGER NOT NULL,
+    last INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    postings BLOB NOT NULL,
+    PRIMARY KEY (word, first)
+);
+'''
@@ -5,20 +5,43 @@ import os
 import sys
 import logging
 import re
-from email.parser import FeedParser
+from email.parser import FeedParser, BytesHeaderParser
 from email.generator import Generator
 from email.message import Message
 import email.utils
 import mimetypes
 import base64
+import binascii
+import codecs
+import contextlib
+import hashlib
+import io
+import argparse
+import json
+import multiprocessing
+import shutil
+import signal
+import socketserver
+import tempfile
+
+import xdg
+import time
 
 logger = logging.getLogger('mime-compiler')
 
+# File backed parts are read in multiples of 57 bytes so that each chunk
+# encodes to whole 76 character base64 lines
+CHUNK_SIZE = 57 * 1024
+
+# Longest line allowed in a message body by RFC 5322
+MAX_LINE_LENGTH = 998
+
+# Bytes read from the start of a file to decide if it is a message
+SNIFF_SIZE = 4096
 
-def get_argparser():
-    import argparse
 
-    parser = argparse.ArgumentParser()
+def get_argparser(parser_class=argparse.ArgumentParser):
+    parser = parser_class()
 
     parser.add_argument('message', nargs='?',
         help='root message')
@@ -29,8 +52,41 @@ def get_argparser():
         help='Enable debug logging')
     parser.add_argument('--info', action='store_true',
         help='Write message information instead of entire message')
+    parser.add_argument('--json', action='store_true',
+        help='Write message information as JSON')
     parser.add_argument('--attach', metavar='FILE', action='append',
         help='Add attachment')
+    parser.add_argument('--stream', action='store_true',
+        help='Stream attachments from disk instead of loading them')
+    parser.add_argument('--cache', action='store_true',
+        help='Keep encoded attachments in a cache for reuse')
+    parser.add_argument('--cache-size', metavar='MB', type=int, default=512,
+        help='Size limit of the attachment cache')
+    parser.add_argument('--8bit', dest='allow_8bit', action='store_true',
+        help='Allow 8bit transfer encoding of UTF-8 text parts')
+
+    # Delivery
+    group = parser.add_argument_group('delivery')
+    group.add_argument('--deliver', metavar='URL',
+        help='Deliver the message to smtp://host:port or lmtp://host:port '
+             'or lmtp:///path/to/socket instead of writing it')
+    group.add_argument('--connections', type=int, default=4,
+        help='Number of connections used when delivering')
+
+    # Compile server
+    group = parser.add_argument_group('compile server')
+    # The default socket is resolved only when serving, see `main`
+    group.add_argument('--serve', metavar='SOCKET', nargs='?', const='',
+        help='Serve compile requests from mimecc.py on a unix socket')
+
+    # Batch compilation
+    group = parser.add_argument_group('batch compilation')
+    group.add_argument('--batch', metavar='MANIFEST',
+        help='Compile every message described in a JSON lines manifest')
+    group.add_argument('--jobs', type=int,
+        help='Number of worker processes used by --batch')
+    group.add_argument('--output-dir', default='.',
+        help='Directory to write messages compiled by --batch to')
 
     # Header modification
     group = parser.add_argument_group('header modification')
@@ -42,14 +98,409 @@ def get_argparser():
         help='Add recipent of the message')
     group.add_argument('--cc', action='append',
         help='Add carbon copy recipent of the message')
+    group.add_argument('--fold-recipents', action='store_true',
+        help='Put all recipents in one header instead of one header each')
 
     return parser
 
 
+# Bytes with the high bit set, and the 7bit bytes quoted-printable escapes
+_high_bytes = bytes(bytearray(range(0x80, 0x100)))
+_qp_unsafe = bytes(bytearray(
+    [b for b in range(0x80) if b < 32 and b not in (9, 10, 13)] + [0x3d, 0x7f]
+))
+
+
+class ByteStats(object):
+    '''Byte statistics of a part body, collected in a single pass
+
+    Data is fed in chunks with `update`, `choose_encoding` then picks the
+    Content-Transfer-Encoding giving the smallest valid output.
+    '''
+
+    def __init__(self):
+        self.size = 0
+        self.high = 0
+        self.nul = 0
+        self.bare_cr = 0
+        self.qp_escaped = 0
+        self.max_line = 0
+        self.utf8 = True
+        self._line = 0
+        self._last_cr = False
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def update(self, chunk):
+        if not chunk:
+            return
+        self.size += len(chunk)
+        high = len(chunk) - len(chunk.translate(None, _high_bytes))
+        self.high += high
+        self.nul += chunk.count(b'\0')
+        self.qp_escaped += high + len(chunk) - len(chunk.translate(None, _qp_unsafe))
+
+        self.bare_cr += chunk.count(b'\r') - chunk.count(b'\r\n')
+        if self._last_cr and chunk.startswith(b'\n'):
+            self.bare_cr -= 1
+        self._last_cr = chunk.endswith(b'\r')
+
+        lines = chunk.split(b'\n')
+        if len(lines) == 1:
+            self._line += len(chunk)
+        else:
+            self.max_line = max(self.max_line, self._line + len(lines[0]),
+                                max(len(l) for l in lines[1:-1]) if len(lines) > 2 else 0)
+            self._line = len(lines[-1])
+
+        if self.utf8:
+            try:
+                self._decoder.decode(chunk)
+            except UnicodeDecodeError:
+                self.utf8 = False
+
+    def close(self):
+        self.max_line = max(self.max_line, self._line)
+        if self.utf8:
+            try:
+                self._decoder.decode(b'', True)
+            except UnicodeDecodeError:
+                self.utf8 = False
+        return self
+
+    def choose_encoding(self, mime, allow_8bit=False):
+        text = mime.startswith('text/')
+        lines_ok = self.nul == 0 and self.bare_cr == 0
+
+        if lines_ok and self.max_line <= MAX_LINE_LENGTH:
+            if self.high == 0:
+                return '7bit'
+            if allow_8bit and text and self.utf8:
+                return '8bit'
+
+        if text and lines_ok:
+            qp_size = self.size + 2 * self.qp_escaped
+            qp_size += 2 * (qp_size // 75)
+            b64_size = (self.size + 2) // 3 * 4
+            b64_size += b64_size // 76
+            if qp_size < b64_size:
+                return 'quoted-printable'
+
+        return 'base64'
+
+
+def analyse(f, digest=None):
+    '''Collect `ByteStats` of the binary file `f`
+
+    If given the hash object `digest` is updated with the data as well.
+    '''
+    stats = ByteStats()
+    for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+        stats.update(chunk)
+        if digest is not None:
+            digest.update(chunk)
+    return stats.close()
+
+
+# Runs of bytes quoted-printable escapes, and the escape of each byte
+_qp_escape = re.compile(br'[^\x21-\x3c\x3e-\x7e \t]+')
+_qp_hex = [('=%02X' % b).encode('ascii') for b in range(256)]
+# Longest encoded line allowed by RFC 2045
+QP_LINE_LENGTH = 76
+
+
+def _escape_qp(match):
+    return b''.join(_qp_hex[b] for b in bytearray(match.group()))
+
+
+def encode_qp(piece, more=False):
+    '''Quoted-printable encode a line, or the part of one in `piece`
+
+    `more` tells if the line goes on in the next piece. Lines are wrapped to
+    `QP_LINE_LENGTH` and an encoded line starting with "From " is escaped so
+    it is not mangled by the generator.
+    '''
+    # binascii is much faster but may wrap lines a little too long and does
+    # not escape "From ", use it when neither happens
+    data = binascii.b2a_qp(piece, istext=True)
+    if more and not piece.endswith(b'\n'):
+        data += b'=\n'
+    if not data.startswith(b'From ') and b'\nFrom ' not in data:
+        if len(data) <= QP_LINE_LENGTH + 1:
+            return data
+        if max(len(line) for line in data.split(b'\n')) <= QP_LINE_LENGTH:
+            return data
+
+    eol = piece.endswith(b'\n')
+    if eol:
+        piece = piece[:-2] if piece.endswith(b'\r\n') else piece[:-1]
+    data = _qp_escape.sub(_escape_qp, piece)
+    if eol and data[-1:] in (b' ', b'\t'):
+        data = data[:-1] + _qp_hex[bytearray(data[-1:])[0]]
+
+    # Leave room for the soft line break when the line goes on
+    last = QP_LINE_LENGTH if eol or not more else QP_LINE_LENGTH - 1
+    lines = []
+    while True:
+        if data.startswith(b'From '):
+            data = b'=46' + data[1:]
+        if len(data) <= last:
+            break
+        # An escape is never split, a literal = is always escaped
+        cut = QP_LINE_LENGTH - 1
+        escape = data.rfind(b'=', cut - 2, cut)
+        if escape != -1:
+            cut = escape
+        lines.append(data[:cut] + b'=\n')
+        data = data[cut:]
+    lines.append(data)
+    if eol:
+        lines.append(b'\n')
+    elif more:
+        lines.append(b'=\n')
+    return b''.join(lines)
+
+
+def encode_body(f, cte):
+    '''Encode the binary file `f` with `cte` yielding chunks of text
+
+    Line breaks in the output are always `\\n`.
+    '''
+    if cte == 'base64':
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            yield base64.encodebytes(chunk).decode('ASCII')
+        return
+
+    charset = 'utf-8' if cte == '8bit' else 'ASCII'
+    pieces = iter(lambda: f.readline(CHUNK_SIZE), b'')
+    piece = next(pieces, None)
+    while piece is not None:
+        following = next(pieces, None)
+        if cte == 'quoted-printable':
+            if following is not None and piece.endswith(b'\r') and len(piece) > 1:
+                # Keep a CRLF split by the read limit together
+                piece, following = piece[:-1], b'\r' + following
+            line = encode_qp(piece, following is not None)
+        else:
+            line = piece
+        yield line.decode(charset).replace('\r\n', '\n')
+        piece = following
+
+
+class FilePart(Message):
+    '''A message part with the body read from a file on demand
+
+    The payload is never held in memory, instead `iter_body` reads and
+    encodes the file in chunks as the message is being generated.
+    '''
+
+    def __init__(self, path, cache=None, digest=None):
+        Message.__init__(self)
+        self.path = path
+        # Cache of encoded bodies and the content hash of the file in it
+        self.cache = cache
+        self.digest = digest
+
+    def iter_body(self, linesep='\n'):
+        cte = self.get('Content-Transfer-Encoding', '7bit').lower()
+        for data in self._encoded(cte):
+            if linesep != '\n':
+                data = data.replace('\n', linesep)
+            yield data
+
+    def _encoded(self, cte):
+        if self.cache is None:
+            with open(self.path, 'rb') as f:
+                for data in encode_body(f, cte):
+                    yield data
+            return
+
+        cached = self.cache.open(self.digest, cte)
+        if cached is not None:
+            logger.debug('using cached body of %r', self.path)
+            with cached as f:
+                for data in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    yield data
+            return
+
+        with open(self.path, 'rb') as f, self.cache.store(self.digest, cte) as out:
+            for data in encode_body(f, cte):
+                out.write(data)
+                yield data
+
+
+class AttachmentCache(object):
+    '''On disk cache of encoded attachment bodies
+
+    Bodies are stored by the SHA-256 of the file content and the transfer
+    encoding. As a fast path the digest and encoding picked for a file is
+    remembered by path, size and modification time so an unchanged file is
+    not read at all. When the bodies grow past `max_size` bytes the least
+    recently used are removed.
+    '''
+
+    def __init__(self, root, max_size=512 * 1024 * 1024):
+        self._bodies = os.path.join(root, 'bodies')
+        self._files = os.path.join(root, 'files')
+        self.max_size = max_size
+        for d in (self._bodies, self._files):
+            if not os.path.exists(d):
+                os.makedirs(d, 0o700)
+
+    def file_key(self, path, mime, allow_8bit):
+        st = os.stat(path)
+        key = '%s\0%d\0%d\0%s\0%d' % (
+            os.path.abspath(path), st.st_size, st.st_mtime_ns, mime, allow_8bit)
+        return hashlib.sha256(key.encode('utf-8', 'surrogateescape')).hexdigest()
+
+    def lookup(self, file_key):
+        '''Get the (digest, encoding, charset) remembered for a file'''
+        try:
+            with open(os.path.join(self._files, file_key)) as f:
+                digest, cte, charset = f.read().split()
+        except (IOError, OSError, ValueError):
+            return None
+        if not os.path.exists(self._body_path(digest, cte)):
+            return None
+        return digest, cte, None if charset == '-' else charset
+
+    def remember(self, file_key, digest, cte, charset=None):
+        self._write_atomic(os.path.join(self._files, file_key),
+                           '%s %s %s\n' % (digest, cte, charset or '-'))
+
+    def _body_path(self, digest, cte):
+        return os.path.join(self._bodies, '%s.%s' % (digest, cte))
+
+    def open(self, digest, cte):
+        '''Open a cached body for reading, None if it is not cached'''
+        path = self._body_path(digest, cte)
+        try:
+            f = open(path, encoding='utf-8', newline='')
+        except (IOError, OSError):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return f
+
+    @contextlib.contextmanager
+    def store(self, digest, cte):
+        '''Context manager for writing a body to the cache
+
+        The body is only added if the block completes without an exception.
+        '''
+        fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=self._bodies)
+        try:
+            with io.open(fd, 'w', encoding='utf-8', newline='') as f:
+                yield f
+            os.rename(tmp, self._body_path(digest, cte))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def _write_atomic(self, path, data):
+        fd, tmp = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(path))
+        with io.open(fd, 'w') as f:
+            f.write(data)
+        os.rename(tmp, path)
+
+    def evict(self):
+        '''Remove the least recently used bodies until within `max_size`'''
+        entries = []
+        total = 0
+        for name in os.listdir(self._bodies):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self._bodies, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size:
+                break
+            logger.debug('evicting %s from attachment cache', path)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+def _has_file_parts(message):
+    return any(isinstance(part, FilePart) for part in message.walk())
+
+
+class StreamingGenerator(Generator):
+    '''Generator writing `FilePart` bodies straight to the output
+
+    `Generator` renders each part to a buffer before writing it out so that it
+    can pick a boundary not found in the body. Messages containing file backed
+    parts are instead written headers first, with a random boundary, so the
+    bodies never need to be buffered.
+    '''
+
+    def _write(self, msg):
+        if not _has_file_parts(msg):
+            return Generator._write(self, msg)
+
+        if isinstance(msg, FilePart):
+            self._write_headers(msg)
+            for data in msg.iter_body(self._NL):
+                self.write(data)
+            return
+
+        boundary = msg.get_boundary()
+        if not boundary:
+            boundary = self._make_boundary()
+            msg.set_boundary(boundary)
+        self._write_headers(msg)
+
+        if msg.preamble is not None:
+            self._write_lines(msg.preamble)
+            self.write(self._NL)
+
+        for i, part in enumerate(msg.get_payload()):
+            if i > 0:
+                self.write(self._NL)
+            self.write('--' + boundary + self._NL)
+            self.clone(self._fp).flatten(part, unixfrom=False, linesep=self._NL)
+
+        self.write(self._NL + '--' + boundary + '--' + self._NL)
+        if msg.epilogue is not None:
+            self._write_lines(msg.epilogue)
+
+
+def normalise_address(address):
+    '''Normalise an address for comparison
+
+    The address is lower cased with the domain in its IDNA (punycode) form.
+    '''
+    local, sep, domain = address.strip().rpartition('@')
+    if not sep:
+        return domain.lower()
+    try:
+        domain = domain.encode('idna').decode('ASCII')
+    except UnicodeError:
+        pass
+    return '%s@%s' % (local.lower(), domain.lower())
+
+
 class MimeCompiler(object):
-    def __init__(self, message=None):
+    def __init__(self, message=None, allow_8bit=False, cache=None,
+                 fold_recipents=False):
         self._message = message or Message()
         self._last_part = self._message
+        self._allow_8bit = allow_8bit
+        self._cache = cache
+        self._fold_recipents = fold_recipents
+        # Mapping header -> set of normalised addresses, built on first use
+        self._recipents = {}
 
     def close(self):
         logger.debug('closing message')
@@ -67,14 +518,36 @@ class MimeCompiler(object):
         del self._message['Subject']
         self._message['Subject'] = subject
 
+    def _recipent_index(self, header):
+        rset = self._recipents.get(header)
+        if rset is None:
+            recipents = email.utils.getaddresses(self._message.get_all(header, []))
+            rset = set(normalise_address(x[1]) for x in recipents if x[1])
+            self._recipents[header] = rset
+        return rset
+
     def _add_recipents(self, header, new):
         logger.debug('adding recipent (%s) %r', header, new)
         message = self._message
-        recipents = email.utils.getaddresses(message.get_all(header, []))
-        rset = set([x[1] for x in recipents])
+        rset = self._recipent_index(header)
+        added = []
         for r in new:
-            if r not in rset:
+            addresses = [normalise_address(x[1])
+                         for x in email.utils.getaddresses([r]) if x[1]]
+            if not addresses or rset.issuperset(addresses):
+                continue
+            rset.update(addresses)
+            added.append(r)
+
+        if not added:
+            return
+        if not self._fold_recipents:
+            for r in added:
                 message[header] = r
+        elif header in message:
+            message.replace_header(header, ', '.join([message[header]] + added))
+        else:
+            message[header] = ', '.join(added)
 
     def add_to(self, recipents):
         self._add_recipents('To', recipents)
@@ -91,14 +564,7 @@ class MimeCompiler(object):
         self._message._payload = [old]
         self._message['Content-Type'] = 'multipart/mixed'
 
-    def attach(self, path, data, mime=None, disposition='attachment'):
-        if not self._message.is_multipart():
-            self.lift()
-
-        if isinstance(data, Message):
-            self._message.attach(data)
-            return
-
+    def _set_part_headers(self, submessage, path, mime, disposition):
         if mime is None:
             mime, enc = mimetypes.guess_type(path)
             mime = mime or 'text/plain'
@@ -106,7 +572,6 @@ class MimeCompiler(object):
         name = os.path.basename(path)
 
         logger.debug('attaching %r as %s', path, mime)
-        submessage = Message()
         submessage['Content-Type'] = mime
 
         binary = not re.match('text/', mime)
@@ -115,53 +580,355 @@ class MimeCompiler(object):
             logger.debug('attachment with name %s [%r]', name, path)
             submessage['Content-Disposition'] = 'attachment; filename="%s"' % name
 
-        try:
-            ascii = data.decode('ASCII')
-            submessage.set_payload(ascii)
-        except UnicodeDecodeError:
-            enc = base64.b64encode(data).decode('ASCII')
-            submessage['Content-Transfer-Encoding'] = 'base64'
-            submessage.set_payload(enc)
+    def _choose_encoding(self, submessage, stats):
+        '''Get the Content-Transfer-Encoding and the charset of a part'''
+        cte = stats.choose_encoding(submessage.get_content_type(), self._allow_8bit)
+        logger.debug('encoding %d bytes as %s', stats.size, cte)
+        # Text that is not ascii is labelled utf-8 whatever the encoding
+        charset = None
+        if submessage.get_content_maintype() == 'text' and stats.high and stats.utf8:
+            charset = 'utf-8'
+        return cte, charset
+
+    def _set_encoding(self, submessage, cte, charset=None):
+        if charset is not None and submessage.get_param('charset') is None:
+            submessage.set_param('charset', charset)
+        if cte != '7bit':
+            submessage['Content-Transfer-Encoding'] = cte
+        return cte
+
+    def attach(self, path, data, mime=None, disposition='attachment'):
+        if not self._message.is_multipart():
+            self.lift()
+
+        if isinstance(data, Message):
+            self._message.attach(data)
+            return
+
+        submessage = Message()
+        self._set_part_headers(submessage, path, mime, disposition)
+
+        cte, charset = self._choose_encoding(submessage, analyse(io.BytesIO(data)))
+        self._set_encoding(submessage, cte, charset)
+        submessage.set_payload(''.join(encode_body(io.BytesIO(data), cte)))
+
+        self._message.attach(submessage)
+        self._last_part = submessage
+
+    def attach_file(self, path, mime=None, disposition='attachment'):
+        '''Attach the file at `path` without loading it
+
+        The file is read and encoded when the message is written with
+        `dump_message`.
+        '''
+        if not self._message.is_multipart():
+            self.lift()
+
+        submessage = FilePart(path, cache=self._cache)
+        self._set_part_headers(submessage, path, mime, disposition)
+
+        cached = None
+        if self._cache is not None:
+            file_key = self._cache.file_key(
+                path, submessage.get_content_type(), self._allow_8bit)
+            cached = self._cache.lookup(file_key)
+
+        if cached is None:
+            # The digest only names the encoded body in the cache
+            digest = hashlib.sha256() if self._cache is not None else None
+            with open(path, 'rb') as f:
+                cte, charset = self._choose_encoding(submessage, analyse(f, digest))
+            if digest is not None:
+                submessage.digest = digest.hexdigest()
+                self._cache.remember(file_key, submessage.digest, cte, charset)
+        else:
+            logger.debug('found %r in attachment cache', path)
+            submessage.digest, cte, charset = cached
+
+        self._set_encoding(submessage, cte, charset)
 
         self._message.attach(submessage)
         self._last_part = submessage
 
 
+# Header field name followed by a colon, the same test `FeedParser` uses to
+# detect header lines
+_header_line = re.compile(br'[\041-\071\073-\176]+:')
+
+
+def looks_like_message(prefix):
+    '''Check if `prefix` starts with a RFC 822 header block
+
+    Only the start of the data is needed, a file is considered a message if
+    the first line (after an optional unix from line) is a header field.
+    '''
+    if b'\0' in prefix:
+        return False
+    if prefix.startswith(b'From '):
+        prefix = prefix.partition(b'\n')[2]
+    return _header_line.match(prefix) is not None
+
+
 def read_file(path):
     if path == '-':
-        file = sys.stdin
+        file = getattr(sys.stdin, 'buffer', sys.stdin)
     else:
         file = open(path, mode='rb')
 
-    parser = FeedParser()
-    logger.debug('loading %r', file.name)
+    logger.debug('loading %r', path)
     with file as f:
-        data = f.read()
-        try:
-            parser.feed(data.decode('utf-8'))
-        except UnicodeDecodeError:
-            return data
+        prefix = f.read(SNIFF_SIZE)
+        data = prefix + f.read()
+    if not looks_like_message(prefix):
+        logger.debug('%r is not a message', path)
+        return data
+
+    parser = FeedParser()
+    try:
+        parser.feed(data.decode('utf-8'))
+    except UnicodeDecodeError:
+        return data
     message = parser.close()
     if len(message._headers) == 0:
         return data
     return message
 
 
-def dump_message(message):
-    generator = Generator(sys.stdout)
-    generator.flatten(message)
+# Longest header line and longest line that still can be a boundary
+# delimiter the structure scanner reads before giving up on finding its end
+_MAX_HEADER_LINE = 64 * 1024
+_MAX_DELIMITER = 1000
 
 
-def main():
-    parser = get_argparser()
-    args = parser.parse_args()
+class StructureScanner(object):
+    '''Scan the MIME structure of a message without loading the bodies
 
-    if args.debug:
-        logging.basicConfig(
-            level=logging.DEBUG,
-            format='%(levelname)s %(asctime)-15s [%(funcName)s] - %(message)s'
-        )
+    The message is read in chunks and only part headers and the lines
+    starting with `--` are looked at. The result is a list with a dict for
+    each part in the order they appear, holding the `depth` in the tree, the
+    `offset` of the part, the `headers`, the `content_type`, the
+    `body_offset` and the `size` of the body in bytes.
+    '''
+
+    def __init__(self):
+        self.parts = []
+        # Stack of [part, boundary] from the root to the current part
+        self._open = []
+        self._header_lines = []
+        self._in_headers = False
+
+    def _start_part(self, offset, default_type='text/plain'):
+        part = {
+            'depth': len(self._open),
+            'offset': offset,
+            'headers': [],
+            'content_type': default_type,
+            'body_offset': None,
+            'size': 0
+        }
+        self.parts.append(part)
+        self._open.append([part, None])
+        self._header_lines = []
+        self._in_headers = True
+
+    def _end_parts(self, depth, end):
+        while len(self._open) > depth:
+            part, boundary = self._open.pop()
+            if part['body_offset'] is None:
+                part['body_offset'] = end
+            part['size'] = max(0, end - part['body_offset'])
+
+    def _end_headers(self, body_offset):
+        part, _ = self._open[-1]
+        self._in_headers = False
+        part['body_offset'] = body_offset
+
+        message = BytesHeaderParser().parsebytes(b''.join(self._header_lines))
+        message.set_default_type(part['content_type'])
+        part['headers'] = [(k, str(v)) for k, v in message.items()]
+        part['content_type'] = ctype = message.get_content_type()
+
+        if message.get_content_maintype() == 'multipart':
+            boundary = message.get_boundary()
+            if boundary is not None:
+                self._open[-1][1] = boundary.encode('ASCII', 'surrogateescape')
+        elif ctype == 'message/rfc822':
+            self._start_part(body_offset)
+
+    def _header_line(self, offset, line):
+        '''Handle a line in a header block
+
+        Returns False if the line is not part of the headers.
+        '''
+        if line.rstrip(b'\r\n') == b'':
+            self._end_headers(offset + len(line))
+        elif self._header_lines and line[:1] in (b' ', b'\t'):
+            self._header_lines.append(line)
+        elif _header_line.match(line) is not None or (
+                not self._header_lines and line.startswith(b'From ')):
+            self._header_lines.append(line)
+        else:
+            self._end_headers(offset)
+            return False
+        return True
+
+    def _body_line(self, offset, line, eol):
+        '''Handle a line starting with `--` in a body
+
+        `eol` is the length of the line ending before the line, which belongs
+        to the delimiter.
+        '''
+        line = line.rstrip(b'\r\n').rstrip(b' \t')
+        for depth in range(len(self._open) - 1, -1, -1):
+            boundary = self._open[depth][1]
+            if boundary is None:
+                continue
+            if line == b'--' + boundary:
+                self._end_parts(depth + 1, offset - eol)
+                self._start_part(offset, self._child_type(depth))
+                return
+            if line == b'--' + boundary + b'--':
+                self._end_parts(depth + 1, offset - eol)
+                self._open[depth][1] = None
+                return
+
+    def _child_type(self, depth):
+        if self._open[depth][0]['content_type'] == 'multipart/digest':
+            return 'message/rfc822'
+        return 'text/plain'
+
+    def scan(self, f, buf=b''):
+        '''Scan the binary file `f`, `buf` is data already read from it'''
+        reader = _ChunkReader(f, buf)
+        self._start_part(0)
+        i = 0
+        line_start = True
+
+        while True:
+            if len(reader.buf) - i < 2 and not reader.eof:
+                i -= reader.read(i - 2)
+                continue
+            buf = reader.buf
+
+            if self._in_headers:
+                j = buf.find(b'\n', i)
+                if j < 0 and not reader.eof and len(buf) - i < _MAX_HEADER_LINE:
+                    i -= reader.read(i - 2)
+                    continue
+                if i >= len(buf):
+                    break
+                end = len(buf) if j < 0 else j + 1
+                if self._header_line(reader.offset + i, buf[i:end]):
+                    i = end
+                line_start = True
+                continue
+
+            # Skip ahead to the next line starting with --
+            if line_start and buf.startswith(b'--', i):
+                k = i
+            else:
+                k = buf.find(b'\n--', i)
+                if k < 0:
+                    if reader.eof:
+                        break
+                    i = max(i, len(buf) - 2)
+                    line_start = False
+                    i -= reader.read(i - 2)
+                    continue
+                k += 1
+
+            j = buf.find(b'\n', k)
+            if j < 0 and not reader.eof and len(buf) - k < _MAX_DELIMITER:
+                # Read the rest of the line
+                i = k
+                line_start = True
+                i -= reader.read(k - 2)
+                continue
+            end = len(buf) if j < 0 else j + 1
 
+            eol = 0
+            if buf[max(0, k - 2):k] == b'\r\n':
+                eol = 2
+            elif buf[max(0, k - 1):k] == b'\n':
+                eol = 1
+            self._body_line(reader.offset + k, buf[k:end], eol)
+            i = end
+            line_start = True
+
+        end = reader.offset + len(reader.buf)
+        if self._in_headers:
+            self._end_headers(end)
+        self._end_parts(0, end)
+        return self.parts
+
+
+class _ChunkReader(object):
+    def __init__(self, f, buf=b''):
+        self._f = f
+        self.buf = buf
+        self.offset = 0
+        self.eof = False
+
+    def read(self, keep):
+        '''Read another chunk dropping the data before `keep`
+
+        Returns the number of bytes dropped from the start of the buffer.
+        '''
+        keep = max(0, keep)
+        data = self._f.read(CHUNK_SIZE)
+        self.eof = not data
+        self.buf = self.buf[keep:] + data
+        self.offset += keep
+        return keep
+
+
+def scan_file(path):
+    '''Scan the structure of the message at `path`
+
+    Returns None if the file is not a message.
+    '''
+    if path == '-':
+        file = getattr(sys.stdin, 'buffer', sys.stdin)
+    else:
+        file = open(path, mode='rb')
+
+    with file as f:
+        prefix = f.read(SNIFF_SIZE)
+        if not looks_like_message(prefix):
+            return None
+        return StructureScanner().scan(f, prefix)
+
+
+def print_info(parts, as_json=False, out=None):
+    out = out or sys.stdout
+    if as_json:
+        json.dump(parts, out, indent=2)
+        out.write('\n')
+        return
+
+    for part in parts:
+        for k, v in part['headers']:
+            print('%s: %s' % (k, v), file=out)
+        if part['body_offset'] is None:
+            print('part of type %s (%d bytes)' % (
+                part['content_type'],
+                part['size']
+            ), file=out)
+        else:
+            print('part of type %s at offset %d (%d bytes)' % (
+                part['content_type'],
+                part['body_offset'],
+                part['size']
+            ), file=out)
+
+
+def dump_message(message, fp=None):
+    generator = StreamingGenerator(fp or sys.stdout)
+    generator.flatten(message)
+
+
+def compile_message(args):
+    '''Compile a message from parsed command line arguments'''
     parts = args.part
     loaded_parts = []
     message = None
@@ -175,7 +942,15 @@ def main():
         else:
             loaded_parts.append((args.message, m, None))
 
-    mimec = MimeCompiler(message)
+    cache = None
+    if args.cache:
+        cache = AttachmentCache(
+            xdg.Context('mimec').cache('attachments'),
+            args.cache_size * 1024 * 1024
+        )
+
+    mimec = MimeCompiler(message, allow_8bit=args.allow_8bit, cache=cache,
+                         fold_recipents=args.fold_recipents)
 
     if args._from:
         mimec.set_from(args._from)
@@ -194,21 +969,316 @@ def main():
 
     if args.attach:
         for att in args.attach:
-            loaded_parts.append((att, read_file(att), 'attachment'))
+            if (args.stream or args.cache) and att != '-':
+                # Read when the message is written
+                loaded_parts.append((att, None, 'attachment'))
+            else:
+                loaded_parts.append((att, read_file(att), 'attachment'))
 
     for part, data, dis in loaded_parts:
-        mimec.attach(part, data=data, disposition=dis)
+        if data is None:
+            mimec.attach_file(part, disposition=dis)
+        else:
+            mimec.attach(part, data=data, disposition=dis)
+
+    return mimec.close()
+
+
+def info(args):
+    '''Scan the structure of the message described by `args`
+
+    A root message without modifications is scanned directly from disk,
+    anything else is compiled to a temporary file first, streaming the
+    attachments so they are never held in memory. The offsets of such a
+    compiled message would point into the deleted file so they are None.
+    '''
+    modified = (args.part or args.attach or args.subject or args._from or
+                args.to or args.cc)
+    if args.message and not modified:
+        parts = scan_file(args.message)
+        if parts is not None:
+            return parts
+
+    args = argparse.Namespace(**dict(vars(args), stream=True))
+    with tempfile.TemporaryFile() as f:
+        out = io.TextIOWrapper(f, encoding='utf-8')
+        dump_message(compile_message(args), out)
+        out.flush()
+        f.seek(0)
+        parts = StructureScanner().scan(f)
+    for part in parts:
+        part['offset'] = part['body_offset'] = None
+    return parts
 
-    message = mimec.close()
 
+def _as_list(value):
+    if value is None or isinstance(value, list):
+        return value
+    return [value]
+
+
+def _compile_batch_item(item):
+    lineno, line, defaults, output_dir = item
+    try:
+        spec = json.loads(line)
+        args = argparse.Namespace(**vars(defaults))
+        args.message = spec.get('message')
+        args.part = _as_list(spec.get('parts')) or []
+        args.attach = _as_list(spec.get('attach'))
+        args.subject = spec.get('subject')
+        args._from = spec.get('from')
+        args.to = _as_list(spec.get('to'))
+        args.cc = _as_list(spec.get('cc'))
+
+        message = compile_message(args)
+        output = spec.get('output') or os.path.join(output_dir, '%d.eml' % lineno)
+        with open(output, 'w', encoding='utf-8') as f:
+            dump_message(message, f)
+        return lineno, output, os.path.getsize(output), None
+    except Exception as e:
+        logger.debug('failed to compile item %d', lineno, exc_info=True)
+        return lineno, None, 0, '%s: %s' % (type(e).__name__, e)
+
+
+def batch(args):
+    '''Compile every message described in the manifest `args.batch`
+
+    Each line of the manifest is a JSON object with the keys `message`,
+    `parts`, `attach`, `subject`, `from`, `to`, `cc` and optionally `output`.
+    Messages without an output are written to `<output-dir>/<line>.eml`.
+
+    Returns the number of items that failed.
+    '''
+    if args.batch == '-':
+        manifest = sys.stdin
+    else:
+        manifest = open(args.batch)
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    start = time.time()
+    count = failed = total_size = 0
+    outputs = []
+    with manifest as f:
+        items = ((lineno, line, args, args.output_dir)
+                 for lineno, line in enumerate(f, 1) if line.strip())
+
+        if args.jobs == 1:
+            pool = None
+            results = map(_compile_batch_item, items)
+        else:
+            pool = multiprocessing.Pool(args.jobs)
+            results = pool.imap_unordered(_compile_batch_item, items, chunksize=8)
+
+        try:
+            for lineno, output, size, error in results:
+                count += 1
+                if error is None:
+                    total_size += size
+                    outputs.append((lineno, output))
+                    logger.debug('compiled item %d to %s', lineno, output)
+                else:
+                    failed += 1
+                    print('%s:%d: %s' % (args.batch, lineno, error), file=sys.stderr)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    elapsed = time.time() - start
+    print('compiled %d of %d messages (%d failed, %d bytes) in %.2fs, %.1f messages/s' % (
+        count - failed,
+        count,
+        failed,
+        total_size,
+        elapsed,
+        count / elapsed if elapsed else 0
+    ), file=sys.stderr)
+
+    if args.deliver:
+        failed += deliver_batch(args, sorted(outputs))
+    return failed
+
+
+def _read_for_delivery(path):
+    import delivery
+    with open(path, 'rb') as f:
+        data = f.read()
+    sender, recipients = delivery.envelope(BytesHeaderParser().parsebytes(data))
+    return sender, recipients, delivery.strip_bcc(data)
+
+
+def deliver_batch(args, outputs):
+    '''Deliver the messages compiled by `batch`, returns the number failed'''
+    start = time.time()
+    results = deliver(
+        args.deliver,
+        (_read_for_delivery(output) for lineno, output in outputs),
+        args.connections
+    )
+
+    failed = 0
+    for (lineno, output), result in zip(outputs, results):
+        if report_delivery('%s:%d' % (args.batch, lineno), result, sys.stderr):
+            failed += 1
+
+    elapsed = time.time() - start
+    print('delivered %d of %d messages in %.2fs, %.1f messages/s' % (
+        len(outputs) - failed,
+        len(outputs),
+        elapsed,
+        len(outputs) / elapsed if elapsed else 0
+    ), file=sys.stderr)
+    return failed
+
+
+def message_bytes(message):
+    out = io.StringIO()
+    dump_message(message, out)
+    return out.getvalue().encode('utf-8')
+
+
+def deliver(url, messages, connections=4):
+    '''Deliver the (sender, recipients, data) tuples in `messages`
+
+    Returns a list of delivery results, see `delivery.deliver_all`.
+    '''
+    import delivery
+    return delivery.deliver(url, messages, connections)
+
+
+def report_delivery(label, result, out=None):
+    '''Print the result of delivering a message, returns True if it failed'''
+    out = out or sys.stdout
+    if isinstance(result, Exception):
+        print('%s: %s' % (label, result), file=out)
+        return True
+    failed = False
+    for recipient, code, message in result:
+        print('%s: %s: %d %s' % (label, recipient, code, message.replace('\n', ' ')), file=out)
+        failed = failed or code // 100 != 2
+    return failed
+
+
+def run(args, out=None):
+    '''Run the command described by `args`, returns the exit status'''
     if args.info:
-        for part in message.walk():
-            for k, v in part.items():
-                print('%s: %s' % (k, v))
-            ctype = part.get_content_type()
-            print('part of type %s' % ctype)
+        print_info(info(args), args.json, out)
+    elif args.deliver:
+        import delivery
+        message = compile_message(args)
+        sender, recipients = delivery.envelope(message)
+        data = delivery.strip_bcc(message_bytes(message))
+        result, = deliver(args.deliver, [(sender, recipients, data)])
+        if report_delivery(args.message or 'message', result, out):
+            return 1
     else:
-        dump_message(message)
+        dump_message(compile_message(args), out)
+    return 0
+
+
+def default_socket():
+    return xdg.Context('mimec').runtime('mimec.sock')
+
+
+class ArgumentError(Exception):
+    pass
+
+
+class _RequestArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        raise ArgumentError('%s: error: %s' % (self.prog, message))
+
+
+class CompileServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    '''Server compiling messages for `mimecc.py` clients
+
+    Each request is handled in a process forked from the server, which already
+    has all modules imported.
+    '''
+
+
+class CompileRequestHandler(socketserver.StreamRequestHandler):
+    '''Handle a compile request
+
+    The request is a line of JSON with the command line arguments `argv` and
+    the working directory `cwd` of the client, followed by the data of stdin.
+    The reply is a line of JSON with the exit `status` and an `error` message,
+    followed by the output when successful.
+    '''
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        logger.debug('compile request %r', request)
+        status, error = 0, None
+
+        with tempfile.TemporaryFile() as f:
+            try:
+                os.chdir(request['cwd'])
+                sys.stdin = io.TextIOWrapper(self.rfile, encoding='utf-8')
+                parser = get_argparser(_RequestArgumentParser)
+                args = parser.parse_args(request['argv'])
+                if args.batch or args.serve is not None:
+                    raise ArgumentError('--batch and --serve are not supported by the server')
+                out = io.TextIOWrapper(f, encoding='utf-8')
+                status = run(args, out)
+                out.flush()
+                out.detach()
+            except ArgumentError as e:
+                status, error = 2, str(e)
+            except Exception as e:
+                logger.debug('compile request failed', exc_info=True)
+                status, error = 1, '%s: %s' % (type(e).__name__, e)
+
+            reply = {'status': status, 'error': error}
+            self.wfile.write(json.dumps(reply).encode('utf-8') + b'\n')
+            if error is None:
+                f.seek(0)
+                shutil.copyfileobj(f, self.wfile)
+
+
+def serve(path):
+    '''Serve compile requests on the unix socket `path` until interrupted'''
+    directory = os.path.dirname(path)
+    if not os.path.exists(directory):
+        os.makedirs(directory, 0o700)
+    if os.path.exists(path):
+        os.unlink(path)
+
+    # Load what the first request would otherwise load
+    mimetypes.init()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    server = CompileServer(path, CompileRequestHandler)
+    os.chmod(path, 0o600)
+    logger.info('serving on %s', path)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def main():
+    parser = get_argparser()
+    args = parser.parse_args()
+
+    if args.debug:
+        logging.basicConfig(
+            level=logging.DEBUG,
+            format='%(levelname)s %(asctime)-15s [%(funcName)s] - %(message)s'
+        )
+
+    if args.serve is not None:
+        return serve(args.serve or default_socket())
+
+    if args.batch:
+        sys.exit(1 if batch(args) else 0)
+
+    sys.exit(run(args))
 
 if __name__ == '__main__':
     main()
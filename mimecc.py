@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+'''Thin client for a mimec compile server
+
+Takes the same arguments as mimec.py and forwards them to a server started
+with `mimec.py --serve`, the socket is taken from $MIMEC_SOCKET or the default
+location. When no server is running mimec.py is run directly instead.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import json
+import socket
+
+import xdg
+
+mimec = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mimec.py')
+
+
+# Options the server does not take, mimec.py is run directly for these
+local_options = ('-h', '--help', '--batch', '--serve')
+
+
+def is_local(argv):
+    '''Check if the command line `argv` must be run by mimec.py directly'''
+    return any(arg.split('=', 1)[0] in local_options for arg in argv)
+
+
+def run_local(argv):
+    os.execv(sys.executable, [sys.executable, mimec] + argv)
+
+
+def connect(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (IOError, OSError):
+        sock.close()
+        return None
+    return sock
+
+
+def main():
+    argv = sys.argv[1:]
+    if is_local(argv):
+        run_local(argv)
+
+    path = os.environ.get('MIMEC_SOCKET') or xdg.Context('mimec').runtime('mimec.sock')
+    sock = connect(path)
+    if sock is None:
+        run_local(argv)
+
+    with sock:
+        request = {'argv': argv, 'cwd': os.getcwd()}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        if '-' in argv:
+            stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+            for data in iter(lambda: stdin.read(65536), b''):
+                sock.sendall(data)
+        sock.shutdown(socket.SHUT_WR)
+
+        f = sock.makefile('rb')
+        reply = json.loads(f.readline().decode('utf-8'))
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        for data in iter(lambda: f.read(65536), b''):
+            stdout.write(data)
+        stdout.flush()
+
+        if reply['error']:
+            print(reply['error'], file=sys.stderr)
+        sys.exit(reply['status'])
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@ import os
 import mailbox
 import logging
 import mcache
+from mcache.fulltext import FullTextIndex
+from instrument import stats
 from sig import signal
 from app import App
 from util import defer
@@ -66,7 +68,13 @@ app = Post()
 
 
 class Maildir(mcache.HeaderUpdaterMixin, mailbox.Maildir):
-    header_cache = mcache.Cache(app.xdg.cache('header_cache'))
+    header_cache = mcache.Cache(
+        app.xdg.cache('header_cache'),
+        max_messages=app.config.get('header_cache_messages'),
+        max_age=app.config.get('header_cache_days', 365) * 24 * 3600
+    )
+    if app.config.get('fulltext_index'):
+        fulltext = FullTextIndex(app.xdg.cache('fulltext'))
     try:
         header_cache.load()
     except:
@@ -123,11 +131,17 @@ class MessageList(Gtk.TreeStore, Gtk.Buildable):
         add = self.append
 
         def copy(messages, iter):
-            for m in messages:
-                if m.message.subject:
+            stack = [(m, iter) for m in reversed(list(messages))]
+            while stack:
+                m, iter = stack.pop()
+                subject = m.message.subject
+                if not subject and m.is_placeholder and m.children:
+                    # Show a placeholder with the subject of its first child
+                    subject = m.children[0].message.subject
+                if subject:
                     # NOTE: Reuses the normalized subject from threadr
                     # might not want to do that
-                    parts = decode_header(m.message.subject)
+                    parts = decode_header(subject)
                     subject = ''.join(
                         [h[0] if h[1] is None else h[0].decode(h[1]) for h in parts]
                     )
@@ -137,21 +151,36 @@ class MessageList(Gtk.TreeStore, Gtk.Buildable):
                     m.message.id,
                     subject
                 ])
-                copy(m._children, citer)
+                stack.extend((c, citer) for c in reversed(list(m.children)))
 
         logger.info('loading mailbox: %s', path)
-        self.mailbox = Maildir(path, create=False)
-        headers = mcache.StubFactory(self.mailbox, self.mailbox.header_cache)
-        self.clear()
-        logger.info('threading %s messages', len(self.mailbox))
-        messages = threader.thread(threader.adapt.read_maildir(headers))
-        messages = list(messages)
-        logger.info('done threading')
-        copy(
-            messages,
-            None
-        )
-        Maildir.header_cache.save()
+        with stats.time('load'):
+            self.mailbox = Maildir(path, create=False)
+            headers = mcache.StubFactory(self.mailbox, self.mailbox.header_cache)
+            self.clear()
+            keys = headers.keys()
+            logger.info('cached headers of %d new messages', headers.warm(keys))
+            with stats.time('headers'):
+                mails = list(threader.adapt.read_maildir(headers.values(keys)))
+            stats.count('messages', len(mails))
+            logger.info('threading %s messages', len(mails))
+            with stats.time('thread'):
+                messages = list(threader.thread(mails))
+            logger.info('done threading')
+            with stats.time('populate'):
+                copy(
+                    messages,
+                    None
+                )
+            Maildir.header_cache.save()
+            if Maildir.fulltext is not None:
+                Maildir.fulltext.save()
+
+        if os.environ.get('POST_STATS'):
+            with open(os.environ['POST_STATS'], 'w') as f:
+                stats.dump(f)
+        # Reset after the dump so the first one includes the cache load
+        stats.reset()
 
 
 class PostWindow(Gtk.Window, Gtk.Buildable):
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+'''Benchmarks of the mime compiler
+
+Generates synthetic messages and measures wall time, throughput and peak
+memory of reading, attaching, adding recipients and dumping messages. Run
+from the repository root:
+
+    python tests/benchmimec.py --output bench.json
+    python tests/benchmimec.py --compare bench.json
+
+Results are written as JSON together with the git revision, so runs of
+different revisions can be compared with --compare.
+'''
+from __future__ import print_function
+
+import os
+import sys
+import gc
+import json
+import time
+import random
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import mimec
+from email.message import Message
+
+
+class Sink(object):
+    '''Output stream counting and discarding what is written'''
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+class Data(object):
+    '''Synthetic input files, generated deterministically from `seed`'''
+
+    def __init__(self, directory, scale=1, seed=0):
+        self._dir = directory
+        self._random = random.Random(seed)
+        self.scale = scale
+
+        self.root_message = self._write('root.eml', self._root_message())
+        self.binary = self._write('binary.bin', self._bytes(int(16 * 1024 * 1024 * scale)))
+        self.small_parts = [
+            self._write('part%d.txt' % i, self._text(1024))
+            for i in range(int(1000 * scale))
+        ]
+        self.recipients = [
+            'Recipient %d <user%d@host%d.example.com>' % (i, i, i % 97)
+            for i in range(int(5000 * scale))
+        ]
+
+    def _write(self, name, data):
+        path = os.path.join(self._dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _bytes(self, size):
+        return bytes(bytearray(self._random.getrandbits(8) for _ in range(4096))) * (size // 4096)
+
+    def _text(self, size):
+        words = ['spam', 'egg', 'bacon', 'sausage', 'lovely', 'wonderful']
+        text = []
+        length = 0
+        while length < size:
+            line = ' '.join(self._random.choice(words) for _ in range(12)) + '\n'
+            text.append(line)
+            length += len(line)
+        return ''.join(text).encode('ASCII')
+
+    def _root_message(self):
+        headers = b'From: john doe <john@inter.net>\nTo: tiffany <breakfast@tiffany.com>\nSubject: Benchmark\n\n'
+        return headers + self._text(int(1024 * 1024 * self.scale))
+
+
+def _file_size(*paths):
+    return sum(os.path.getsize(p) for p in paths)
+
+
+def cases(data):
+    '''Yield (name, setup, run, size, unit) for each benchmark
+
+    `setup` returns the arguments for `run`, it is not part of the measurement.
+    '''
+    yield ('read_file.root_message', lambda: (data.root_message,),
+           mimec.read_file, _file_size(data.root_message), 'bytes')
+
+    yield ('read_file.binary', lambda: (data.binary,),
+           mimec.read_file, _file_size(data.binary), 'bytes')
+
+    def attach_parts(compiler, parts):
+        for path, content in parts:
+            compiler.attach(path, content)
+    yield ('attach.small_parts',
+           lambda: (mimec.MimeCompiler(Message()),
+                    [(p, mimec.read_file(p)) for p in data.small_parts]),
+           attach_parts, len(data.small_parts), 'parts')
+
+    yield ('attach.binary',
+           lambda: (mimec.MimeCompiler(Message()), [(data.binary, mimec.read_file(data.binary))]),
+           attach_parts, _file_size(data.binary), 'bytes')
+
+    def add_recipients(compiler, recipients):
+        for i in range(0, len(recipients), 100):
+            compiler._add_recipents('To', recipients[i:i + 100])
+    yield ('add_recipents',
+           lambda: (mimec.MimeCompiler(Message()), data.recipients),
+           add_recipients, len(data.recipients), 'recipients')
+
+    def compiled(attach):
+        compiler = mimec.MimeCompiler(mimec.read_file(data.root_message))
+        for path in data.small_parts:
+            compiler.attach(path, mimec.read_file(path))
+        attach(compiler)
+        return compiler.close(), Sink()
+    size = _file_size(data.root_message, data.binary, *data.small_parts)
+
+    yield ('dump_message',
+           lambda: compiled(lambda c: c.attach(data.binary, mimec.read_file(data.binary))),
+           mimec.dump_message, size, 'bytes')
+
+    yield ('dump_message.streamed',
+           lambda: compiled(lambda c: c.attach_file(data.binary)),
+           mimec.dump_message, size, 'bytes')
+
+
+def measure(setup, run, repeat):
+    times = []
+    for _ in range(repeat):
+        args = setup()
+        gc.collect()
+        start = time.perf_counter()
+        run(*args)
+        times.append(time.perf_counter() - start)
+        del args
+
+    # Memory is measured in a separate run as tracing slows it down
+    args = setup()
+    gc.collect()
+    tracemalloc.start()
+    run(*args)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return times, peak
+
+
+def revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode('ASCII').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(scale=1, repeat=3, only=None):
+    results = []
+    directory = tempfile.mkdtemp(prefix='benchmimec')
+    try:
+        data = Data(directory, scale)
+        for name, setup, run, size, unit in cases(data):
+            if only and not any(name.startswith(o) for o in only):
+                continue
+            times, peak = measure(setup, run, repeat)
+            best = min(times)
+            result = {
+                'name': name,
+                'times': times,
+                'best': best,
+                'mean': sum(times) / len(times),
+                'size': size,
+                'unit': unit,
+                'throughput': size / best if best else None,
+                'peak_memory': peak
+            }
+            print('%-24s %8.3fs %12.1f %s/s %10.1f MiB peak' % (
+                name, best, result['throughput'] or 0, unit, peak / 1024.0 / 1024.0
+            ), file=sys.stderr)
+            results.append(result)
+    finally:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    return {
+        'revision': revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': scale,
+        'repeat': repeat,
+        'results': results
+    }
+
+
+def compare(old, new):
+    '''Print the change of each benchmark from `old` to `new`'''
+    previous = dict((r['name'], r) for r in old['results'])
+    print('comparing %s to %s' % (old['revision'], new['revision']))
+    for result in new['results']:
+        before = previous.get(result['name'])
+        if before is None:
+            continue
+        print('%-24s time %+7.1f%%  peak memory %+7.1f%%' % (
+            result['name'],
+            100.0 * (result['best'] - before['best']) / before['best'],
+            100.0 * (result['peak_memory'] - before['peak_memory']) / max(before['peak_memory'], 1)
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the mime compiler')
+    parser.add_argument('--scale', type=float, default=1,
+        help='Scale the size of the generated data')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='Number of timed runs of each benchmark')
+    parser.add_argument('--only', action='append',
+        help='Only run benchmarks with names starting with this')
+    parser.add_argument('--output', metavar='FILE',
+        help='Write results as JSON to FILE')
+    parser.add_argument('--compare', metavar='FILE',
+        help='Compare results with an earlier run')
+    args = parser.parse_args()
+
+    results = benchmark(args.scale, args.repeat, args.only)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    elif not args.compare:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == '__main__':
+    main()
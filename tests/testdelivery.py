@@ -0,0 +1,148 @@
+import asyncio
+import unittest
+import delivery
+
+
+class StandInServer(object):
+    '''A minimal SMTP/LMTP server recording the delivered messages
+
+    Recipients containing "reject" are refused.
+    '''
+
+    def __init__(self, lmtp=False, pipelining=True):
+        self.lmtp = lmtp
+        self.pipelining = pipelining
+        self.messages = []
+        self.connections = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        port = self._server.sockets[0].getsockname()[1]
+        return '%s://127.0.0.1:%d' % ('lmtp' if self.lmtp else 'smtp', port)
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        write = lambda line: writer.write(line.encode('ascii') + b'\r\n')
+        write('220 stand-in ready')
+        sender, recipients = None, []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode('ascii').rstrip('\r\n')
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'LHLO'):
+                write('250-stand-in')
+                if self.pipelining:
+                    write('250-PIPELINING')
+                write('250 8BITMIME')
+            elif verb == 'MAIL':
+                sender, recipients = command[10:].strip('<>'), []
+                write('250 ok')
+            elif verb == 'RCPT':
+                recipient = command[8:].strip('<>')
+                if 'reject' in recipient:
+                    write('550 no such user')
+                else:
+                    recipients.append(recipient)
+                    write('250 ok')
+            elif verb == 'DATA':
+                if not recipients:
+                    write('554 no valid recipients')
+                    continue
+                write('354 go ahead')
+                await writer.drain()
+                data = []
+                while True:
+                    line = await reader.readline()
+                    if line == b'.\r\n':
+                        break
+                    data.append(line[1:] if line.startswith(b'.') else line)
+                self.messages.append((sender, recipients, b''.join(data)))
+                if self.lmtp:
+                    for recipient in recipients:
+                        write('250 delivered to %s' % recipient)
+                else:
+                    write('250 queued')
+                sender, recipients = None, []
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                write('250 ok')
+            elif verb == 'QUIT':
+                write('221 bye')
+                break
+            else:
+                write('500 unknown command')
+            await writer.drain()
+        writer.close()
+
+
+class TestDelivery(unittest.TestCase):
+    def deliver(self, server, messages, connections=1):
+        async def run():
+            url = await server.start()
+            try:
+                return await delivery.deliver_all(url, messages, connections)
+            finally:
+                await server.stop()
+        return asyncio.run(run())
+
+    def test_smtp(self):
+        server = StandInServer()
+        data = b'Subject: test\n\n.leading dot\nbody\n'
+        result, = self.deliver(server, [
+            ('me@here.org', ['you@there.org', 'reject@there.org'], data)
+        ])
+        self.assertEqual([
+            ('you@there.org', 250),
+            ('reject@there.org', 550)
+        ], [(r.recipient, r.code) for r in result])
+        self.assertEqual([
+            ('me@here.org', ['you@there.org'], data.replace(b'\n', b'\r\n'))
+        ], server.messages)
+
+    def test_lmtp(self):
+        server = StandInServer(lmtp=True, pipelining=False)
+        result, = self.deliver(server, [
+            ('me@here.org', ['a@there.org', 'b@there.org'], b'Subject: test\n\nbody\n')
+        ])
+        self.assertEqual([
+            ('a@there.org', 250, 'delivered to a@there.org'),
+            ('b@there.org', 250, 'delivered to b@there.org')
+        ], result)
+
+    def test_reuse_connection(self):
+        server = StandInServer()
+        messages = [
+            ('me@here.org', ['reject@there.org'], b'Subject: none\n\nbody\n')
+        ] + [
+            ('me@here.org', ['you%d@there.org' % i], b'Subject: %d\n\nbody\n' % i)
+            for i in range(10)
+        ]
+        results = self.deliver(server, messages)
+        self.assertEqual(550, results[0][0].code)
+        self.assertTrue(all(r[0].code == 250 for r in results[1:]))
+        self.assertEqual(10, len(server.messages))
+        self.assertEqual(1, server.connections)
+
+    def test_envelope(self):
+        from email.message import Message
+        message = Message()
+        message['From'] = 'Me <me@here.org>'
+        message['To'] = 'a@there.org, B <b@there.org>'
+        message['Cc'] = 'a@there.org'
+        self.assertEqual(
+            ('me@here.org', ['a@there.org', 'b@there.org']),
+            delivery.envelope(message))
+
+    def test_strip_bcc(self):
+        data = (b'From: me@here.org\r\nBcc: a@there.org,\r\n b@there.org\r\n'
+                b'To: c@there.org\r\nbcc : d@there.org\r\n\r\nBcc: body\r\n')
+        self.assertEqual(
+            b'From: me@here.org\r\nTo: c@there.org\r\n\r\nBcc: body\r\n',
+            delivery.strip_bcc(data))
+        self.assertEqual(b'Subject: x\n\nbody\n', delivery.strip_bcc(b'Subject: x\n\nbody\n'))
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import unittest
+import email.message
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from mcache import fulltext
+
+
+def message(text, subtype='plain', charset='utf-8'):
+    return MIMEText(text, subtype, charset)
+
+
+class TestFullTextIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'fulltext')
+        self.index = fulltext.FullTextIndex(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def key(self, i):
+        return ('maildir', ('/mail/inbox', str(i)))
+
+    def search(self, query, index=None):
+        return sorted(key[1][1] for key in (index or self.index).search(query))
+
+    def test_varints(self):
+        numbers = [0, 1, 127, 128, 300, 2 ** 40]
+        data = fulltext.encode_varints(numbers, bytearray())
+        self.assertEqual(numbers, list(fulltext.decode_varints(data)))
+
+    def test_search(self):
+        self.index.add(self.key(1), message('Lunch next friday?'))
+        self.index.add(self.key(2), message('Friday is next, lunch is not'))
+        self.index.add(self.key(3), message('<p>Sm\xf6rg\xe5s for <b>lunch</b></p>', 'html'))
+        self.index.save()
+
+        self.assertEqual(['1', '2', '3'], self.search('lunch'))
+        self.assertEqual(['1', '2'], self.search('LUNCH friday'))
+        self.assertEqual(['1'], self.search('"next friday"'))
+        self.assertEqual(['2'], self.search('"friday is next"'))
+        self.assertEqual(['3'], self.search('sm\xf6rg\xe5s lunch'))
+        self.assertEqual([], self.search('dinner lunch'))
+        self.assertEqual([], self.search('"friday next"'))
+
+    def test_incremental(self):
+        self.index.flush_size = 2
+        for i in range(5):
+            self.index.add(self.key(i), message('common word%d' % i))
+        self.assertFalse(self.index.add(self.key(0), message('other')))
+        self.index.save()
+
+        index = fulltext.FullTextIndex(self.path)
+        index.add(self.key(5), message('common'))
+        index.save()
+        self.assertEqual([str(i) for i in range(6)], self.search('common', index))
+        self.assertEqual(['3'], self.search('word3', index))
+
+        index.remove(self.key(3))
+        self.assertEqual([], self.search('word3', index))
+        self.assertEqual(5, len(index.search('common')))
+
+    def test_multipart(self):
+        mail = MIMEMultipart()
+        mail.attach(message('the body'))
+        attachment = email.message.Message()
+        attachment.set_type('application/octet-stream')
+        attachment.set_payload('binary words')
+        mail.attach(attachment)
+        self.assertEqual('the body', fulltext.message_text(mail))
+
+    def test_indexed_elsewhere(self):
+        other = fulltext.FullTextIndex(self.path)
+        other.add(self.key(2), message('lunch at two'))
+        other.save()
+
+        for i in range(1, 4):
+            self.index.add(self.key(i), message('lunch at %d' % i))
+        self.index.save()
+        self.assertEqual(['1', '2', '3'], self.search('lunch'))
+        self.assertEqual(['2'], self.search('two'))
+        self.assertEqual([], self.search('2'))
+
+        self.index.add(self.key(4), message('lunch again'))
+        self.index.save()
+        self.assertEqual(['1', '2', '3', '4'], self.search('lunch'))
+
+    def test_blocks(self):
+        self.index.block_size = 3
+        self.index.flush_size = 2
+        for i in range(10):
+            self.index.add(self.key(i), message('common %s' % ('odd' if i % 2 else 'even')))
+        self.index.save()
+
+        blocks = self.index._connect().execute(
+            'SELECT first, last, count FROM block WHERE word = ? ORDER BY first',
+            ('common',)).fetchall()
+        self.assertEqual([(1, 4, 4), (5, 8, 4), (9, 10, 2)], blocks)
+        self.assertEqual([str(i) for i in range(10)], self.search('common'))
+        self.assertEqual(['1', '3', '5', '7', '9'], self.search('odd common'))
+        self.assertEqual(['0', '2', '4', '6', '8'], self.search('common even'))
+        self.assertEqual({9: [0], 10: [0]}, self.index._postings('common', [9]))
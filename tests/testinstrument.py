@@ -0,0 +1,35 @@
+import io
+import json
+import unittest
+import instrument
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self):
+        self.stats = instrument.Stats()
+
+    def test_count(self):
+        self.stats.count('hit')
+        self.stats.count('hit', 2)
+        self.assertEqual({'hit': 3}, self.stats.report()['counters'])
+
+    def test_time(self):
+        for seconds in (0.5, 1.5):
+            self.stats.add_time('load', seconds)
+        with self.stats.time('save'):
+            pass
+        timers = self.stats.report()['timers']
+        self.assertEqual({'calls': 2, 'total': 2.0, 'max': 1.5}, timers['load'])
+        self.assertEqual(1, timers['save']['calls'])
+
+    def test_dump(self):
+        self.stats.count('messages', 10)
+        f = io.StringIO()
+        self.stats.dump(f)
+        self.assertEqual(self.stats.report(), json.loads(f.getvalue()))
+
+    def test_timed(self):
+        instrument.stats.reset()
+        square = instrument.timed('square')(lambda x: x * x)
+        self.assertEqual(4, square(2))
+        self.assertEqual(1, instrument.stats.report()['timers']['square']['calls'])
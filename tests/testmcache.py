@@ -0,0 +1,424 @@
+import os
+import email.message
+import mailbox
+import pickle
+import shutil
+import tempfile
+import unittest
+import mcache
+from instrument import stats
+
+
+def headers(message_id, subject='Hello'):
+    return {
+        'Message-Id': message_id,
+        'From': 'john doe <john@inter.net>',
+        'Subject': subject
+    }
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'header_cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def cache(self):
+        cache = mcache.Cache(self.path)
+        cache.load()
+        return cache
+
+    def test_get(self):
+        cache = self.cache()
+        key = cache.pathspec('maildir', ('/mail/inbox', '1234'))
+        cache[key] = headers('<1@inter.net>')
+        self.assertEqual([
+            ('Message-Id', '<1@inter.net>'),
+            ('From', 'john doe <john@inter.net>'),
+            ('Subject', 'Hello')
+        ], cache['<1@inter.net>'])
+        self.assertEqual(cache['<1@inter.net>'], cache[key])
+        self.assertEqual(set([key]), cache.lookup('<1@inter.net>'))
+
+    def test_save_load(self):
+        cache = self.cache()
+        key = cache.pathspec('maildir', ('/mail/inbox', '1234'))
+        cache[key] = headers('<1@inter.net>')
+        cache.save()
+
+        cache = self.cache()
+        self.assertEqual('Hello', dict(cache[key])['Subject'])
+        self.assertEqual(set([key]), cache.lookup('<1@inter.net>'))
+
+    def test_save_changes_only(self):
+        cache = self.cache()
+        for i in range(100):
+            cache[('maildir', ('/mail/inbox', str(i)))] = headers('<%d@inter.net>' % i)
+        cache.save()
+
+        cache = self.cache()
+        cache[('maildir', ('/mail/inbox', '5'))] = headers('<5@inter.net>', 'Changed')
+        changes = cache._db.total_changes
+        cache.save()
+        self.assertEqual(2, cache._db.total_changes - changes)
+
+        cache = self.cache()
+        self.assertEqual('Changed', dict(cache['<5@inter.net>'])['Subject'])
+        self.assertEqual('Hello', dict(cache['<6@inter.net>'])['Subject'])
+
+    def test_load_lazily(self):
+        cache = self.cache()
+        for i in range(10):
+            cache[('maildir', ('/mail/inbox', str(i)))] = headers('<%d@inter.net>' % i)
+        cache.save()
+
+        cache = self.cache()
+        self.assertEqual([], cache._records)
+        self.assertEqual('<3@inter.net>', dict(cache[('maildir', ('/mail/inbox', '3'))])['Message-Id'])
+        self.assertEqual(1, len(cache._records))
+        self.assertRaises(KeyError, lambda: cache['<missing@inter.net>'])
+        self.assertEqual(set(), cache.lookup('<missing@inter.net>'))
+        self.assertRaises(KeyError, cache.lookup, None)
+        self.assertEqual(1, len(cache._records))
+
+        # A pathspec changed in memory is not overridden by the stored one
+        moved = ('maildir', ('/mail/inbox', '4'))
+        cache[moved] = headers('<5@inter.net>')
+        self.assertEqual(set([('maildir', ('/mail/inbox', '5')), moved]),
+                         cache.lookup('<5@inter.net>'))
+        self.assertEqual(set(), cache.lookup('<4@inter.net>'))
+
+    def test_concurrent_save(self):
+        first, second = self.cache(), self.cache()
+        first[('maildir', ('/mail/inbox', '1'))] = headers('<1@inter.net>')
+        second[('maildir', ('/mail/inbox', '2'))] = headers('<2@inter.net>')
+        second[('maildir', ('/mail/sent', '1'))] = headers('<1@inter.net>')
+        self.assertRaises(KeyError, lambda: first['<2@inter.net>'])
+        self.assertEqual(1, len(second.lookup('<1@inter.net>')))
+        second.save()
+        first.save()
+
+        # Misses are read again and pathspecs after a refresh
+        self.assertEqual('<2@inter.net>', dict(first['<2@inter.net>'])['Message-Id'])
+        self.assertEqual(1, len(second.lookup('<1@inter.net>')))
+        second.refresh()
+        self.assertEqual(2, len(second.lookup('<1@inter.net>')))
+
+        cache = self.cache()
+        self.assertEqual('<1@inter.net>', dict(cache[('maildir', ('/mail/inbox', '1'))])['Message-Id'])
+        self.assertEqual('<2@inter.net>', dict(cache[('maildir', ('/mail/inbox', '2'))])['Message-Id'])
+
+    def test_evict(self):
+        cache = self.cache()
+        for i in range(10):
+            cache[('maildir', ('/mail/inbox', str(i)))] = headers('<%d@inter.net>' % i)
+        cache.save()
+        cache._db.executemany('UPDATE message SET used = ? WHERE message_id = ?', [
+            (i, ('<%d@inter.net>' % i).encode('ascii')) for i in range(10)])
+        cache._db.commit()
+
+        cache = mcache.Cache(self.path, max_messages=5)
+        cache.load()
+        for i in range(10):
+            cache.lookup('<%d@inter.net>' % i)
+        cache['<0@inter.net>']
+        cache.save()
+        # The evicted messages are dropped from memory too and their numbers reused
+        self.assertEqual(set(), cache.lookup('<1@inter.net>'))
+        self.assertEqual(5, len(cache._numbers))
+        cache[('maildir', ('/mail/inbox', 'new'))] = headers('<new@inter.net>')
+        self.assertEqual(10, len(cache._message_ids))
+        self.assertEqual(['new'], [k[1][1] for k in cache.lookup('<new@inter.net>')])
+
+        cache = self.cache()
+        self.assertEqual(
+            ['0', '6', '7', '8', '9'],
+            sorted(key[1][1] for i in range(10) for key in cache.lookup('<%d@inter.net>' % i)))
+        self.assertRaises(KeyError, lambda: cache['<1@inter.net>'])
+
+    def test_read_only_save(self):
+        cache = mcache.Cache(self.path, max_messages=1000)
+        cache.load()
+        for i in range(100):
+            cache[('maildir', ('/mail/inbox', str(i)))] = headers('<%d@inter.net>' % i)
+        cache.save()
+
+        cache = mcache.Cache(self.path, max_messages=1000)
+        cache.load()
+        for i in range(100):
+            cache[('maildir', ('/mail/inbox', str(i)))]
+        changes = cache._db.total_changes
+        cache.save()
+        self.assertEqual(changes, cache._db.total_changes)
+
+        # A time of use older than the resolution is updated once
+        cache._db.execute('UPDATE message SET used = 0')
+        cache._db.commit()
+        cache = mcache.Cache(self.path, max_messages=1000)
+        cache.load()
+        for i in range(10):
+            cache['<%d@inter.net>' % i]
+            cache['<%d@inter.net>' % i]
+        changes = cache._db.total_changes
+        cache.save()
+        self.assertEqual(changes + 10, cache._db.total_changes)
+        cache.save()
+        self.assertEqual(changes + 10, cache._db.total_changes)
+
+    def test_gc(self):
+        inbox = mailbox.Maildir(os.path.join(self.dir, 'inbox'))
+        kept = inbox.add(email.message.Message())
+        cache = self.cache()
+        cache[('maildir', (inbox._path, kept))] = headers('<1@inter.net>')
+        cache[('maildir', (inbox._path, 'gone'))] = headers('<2@inter.net>')
+        cache[('maildir', ('/no/such/maildir', '1'))] = headers('<3@inter.net>')
+        self.assertEqual(2, cache.gc())
+        self.assertEqual(['<1@inter.net>'], list(cache._numbers))
+        self.assertEqual([{kept: 0}, {}], cache._resolve)
+
+        cache = self.cache()
+        self.assertEqual(1, len(cache.lookup('<1@inter.net>')))
+        self.assertRaises(KeyError, lambda: cache['<2@inter.net>'])
+        self.assertEqual(set(), cache.lookup('<3@inter.net>'))
+
+    def test_search(self):
+        cache = mcache.Cache(self.path, indexed=True)
+        cache.load()
+        messages = [
+            ('John Doe <John@inter.net>', 'Re: Lunch plans', 'Mon, 1 Jun 2015 12:00:00 +0000'),
+            ('jane@inter.net', 'Lunch', 'Tue, 2 Jun 2015 12:00:00 +0000'),
+            ('john@inter.net', '=?utf-8?q?Sm=C3=B6rg=C3=A5s?= plans', 'Wed, 3 Jun 2015 12:00:00 +0000'),
+        ]
+        for i, (sender, subject, date) in enumerate(messages):
+            cache[('maildir', ('/mail/inbox', str(i)))] = {
+                'Message-Id': '<%d@inter.net>' % i,
+                'From': sender,
+                'Subject': subject,
+                'Date': date
+            }
+        cache.save()
+
+        def search(**criteria):
+            return sorted(key[1][1] for key in cache.search(**criteria))
+
+        self.assertEqual(['0', '2'], search(sender='JOHN@inter.net'))
+        self.assertEqual(['0', '1'], search(subject='lunch'))
+        self.assertEqual(['0'], search(subject='plans lunch'))
+        self.assertEqual(['2'], search(subject='smörgås'))
+        self.assertEqual(['1', '2'], search(since=1433246400))
+        self.assertEqual(['1'], search(since=1433246400, until=1433289600))
+        self.assertEqual(['2'], search(sender='john@inter.net', since=1433246400))
+
+    def test_build_index(self):
+        cache = self.cache()
+        cache[('maildir', ('/mail/inbox', '1'))] = headers('<1@inter.net>', 'Indexed later')
+        cache.save()
+
+        cache = mcache.Cache(self.path, indexed=True)
+        cache.load()
+        self.assertEqual(set(), cache.search(subject='later'))
+        self.assertEqual(1, cache.build_index())
+        self.assertEqual(set([('maildir', ('/mail/inbox', '1'))]), cache.search(subject='later'))
+
+    def test_search_legacy(self):
+        with open(self.path, 'wb') as f:
+            pickle.dump({'messages': {}, 'resolve': {}, 'index': {}}, f)
+        cache = mcache.Cache(self.path, indexed=True)
+        cache.load()
+        self.assertEqual(0, cache.build_index())
+        self.assertEqual(set(), cache.search(subject='hello'))
+
+    def test_convert_pickle(self):
+        key = ('maildir', ('/mail/inbox', '1234'))
+        items = [('Message-Id', '<1@inter.net>'), ('From', 'john@inter.net'),
+                 ('Subject', 'Old'), ('References', '<0@inter.net>'),
+                 ('In-Reply-To', '<0@inter.net>'), ('Date', 'Mon, 1 Jan 2001 12:00:00 +0000')]
+        stale = ('maildir', ('/mail/inbox', '5678'))
+        with open(self.path, 'wb') as f:
+            pickle.dump({
+                'messages': {'<1@inter.net>': items, '<2@inter.net>': [('Subject', 'Old')]},
+                'resolve': {key: '<1@inter.net>', stale: '<2@inter.net>'},
+                'index': {'<1@inter.net>': set([key]), '<2@inter.net>': set([stale])}
+            }, f)
+
+        cache = self.cache()
+        self.assertEqual(items, cache[key])
+        # Records without all the headers now cached are read again
+        self.assertRaises(KeyError, lambda: cache[stale])
+        cache.save()
+
+        cache = self.cache()
+        self.assertEqual(items, cache[key])
+        self.assertRaises(KeyError, lambda: cache[stale])
+        self.assertEqual(set([stale]), cache.lookup('<2@inter.net>'))
+
+    def test_stale_record(self):
+        cache = self.cache()
+        key = ('maildir', ('/mail/inbox', '1'))
+        message = headers('<1@inter.net>')
+        cache[key] = message
+        cache.save()
+        # Saved before Date was cached
+        cache._db.execute('UPDATE message SET headers = ?', (
+            pickle.dumps([('Message-Id', '<1@inter.net>'), ('Subject', 'Hello')], 2),))
+        cache._db.commit()
+
+        cache = self.cache()
+        self.assertRaises(KeyError, lambda: cache[key])
+        cache[key] = message
+        cache.save()
+        cache = self.cache()
+        self.assertEqual(sorted(message.items()), sorted(cache[key]))
+
+    def test_several_paths(self):
+        cache = self.cache()
+        inbox = ('maildir', ('/mail/inbox', '1'))
+        sent = ('maildir', ('/mail/sent', '1'))
+        other = ('imap', 'uid-1')
+        for key in (inbox, sent, other):
+            cache[key] = headers('<1@inter.net>')
+        self.assertEqual(set([inbox, sent, other]), cache.lookup('<1@inter.net>'))
+
+        # Moving a pathspec to another message
+        cache[sent] = headers('<2@inter.net>')
+        self.assertEqual(set([inbox, other]), cache.lookup('<1@inter.net>'))
+        self.assertEqual(set([sent]), cache.lookup('<2@inter.net>'))
+        cache.save()
+
+        cache = self.cache()
+        self.assertEqual(set([inbox, other]), cache.lookup('<1@inter.net>'))
+        self.assertEqual('<2@inter.net>', dict(cache[sent])['Message-Id'])
+        self.assertEqual(set(), cache.lookup('<3@inter.net>'))
+
+
+class Maildir(mcache.HeaderUpdaterMixin, mailbox.Maildir):
+    pass
+
+
+class TestScan(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'header_cache')
+        self.cache = mcache.Cache(self.path)
+        self.cache.load()
+        self.maildir = Maildir(os.path.join(self.dir, 'inbox'))
+        self.maildir.header_cache = self.cache
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def add(self, i):
+        message = email.message.Message()
+        message['Message-Id'] = '<%d@inter.net>' % i
+        return self.maildir.add(message)
+
+    def age(self):
+        # Make the directories old enough for a snapshot to be trusted
+        for d in ('new', 'cur'):
+            path = os.path.join(self.maildir._path, d)
+            os.utime(path, (0, os.stat(path).st_mtime - 10))
+
+    def factory(self):
+        return mcache.StubFactory(self.maildir, self.cache)
+
+    def test_delta(self):
+        first = self.add(1)
+        self.age()
+        keys, added, removed = self.factory().scan()
+        self.assertEqual([first], keys)
+        self.assertEqual([first], list(added))
+
+        # Unchanged directories are not listed
+        self.maildir.keys = None
+        keys, added, removed = self.factory().scan()
+        self.assertEqual(([first], (), ()), (keys, added, removed))
+        del self.maildir.keys
+
+        self.maildir[first]
+        self.assertEqual(1, len(self.cache.lookup('<1@inter.net>')))
+        second = self.add(2)
+        self.maildir.remove(first)
+        self.age()
+        keys, added, removed = self.factory().scan()
+        self.assertEqual([second], keys)
+        self.assertEqual([second], list(added))
+        self.assertEqual(set([first]), set(removed))
+        self.assertEqual(set(), self.cache.lookup('<1@inter.net>'))
+        self.cache.save()
+
+        self.cache = mcache.Cache(self.path)
+        self.cache.load()
+        self.assertEqual(set(), self.cache.lookup('<1@inter.net>'))
+
+    def test_snapshot_saved(self):
+        first = self.add(1)
+        self.age()
+        self.factory().scan()
+        self.cache.save()
+
+        self.cache = mcache.Cache(self.path)
+        self.cache.load()
+        self.assertEqual([first], list(self.cache.snapshot(self.maildir._path)[1]))
+
+    def test_scan_legacy(self):
+        with open(self.path, 'wb') as f:
+            pickle.dump({'messages': {}, 'resolve': {}, 'index': {}}, f)
+        self.cache = mcache.Cache(self.path)
+        self.cache.load()
+        self.maildir.header_cache = self.cache
+        first = self.add(1)
+        self.assertEqual([first], self.factory().scan()[0])
+
+    def test_recent_change_not_trusted(self):
+        self.add(1)
+        self.factory().scan()
+        self.assertIsNone(self.cache.snapshot(self.maildir._path))
+
+    def test_warm(self):
+        keys = []
+        for i in range(20):
+            keys.append(self.maildir.add(
+                b'Message-Id: <%d@inter.net>\nSubject: %s\n\n%s' % (
+                    i, b'Long\n ' * (i * 200), b'body\n' * 10000)))
+        factory = self.factory()
+        factory[keys[0]]
+        self.assertEqual(19, factory.warm(workers=4))
+
+        self.maildir.get_message = None
+        for i, key in enumerate(keys):
+            message = factory[key]
+            self.assertEqual('<%d@inter.net>' % i, message['Message-Id'])
+            self.assertEqual(i * 200, message['Subject'].count('Long'))
+        self.assertEqual(0, factory.warm())
+
+    def test_8bit_headers(self):
+        keys = [self.maildir.add(
+            b'Message-Id: <%d@inter.net>\nFrom: J\xc3\xb6rg <j@x.org>\n'
+            b'In-Reply-To: <r\xc3\xb6@x.org>\n\nbody\n' % i) for i in range(2)]
+        factory = self.factory()
+        self.assertEqual(1, factory.warm(keys[:1]))
+        # A miss reads the message through the maildir
+        self.assertEqual('<1@inter.net>', factory[keys[1]]['Message-Id'])
+        self.cache.save()
+
+        cache = mcache.Cache(self.path)
+        cache.load()
+        for i, key in enumerate(keys):
+            headers = dict(cache[self.maildir.cache_key(key)])
+            self.assertEqual('<%d@inter.net>' % i, headers['Message-Id'])
+            self.assertIn('j@x.org', str(headers['From']))
+
+    def test_values(self):
+        for i in range(3):
+            self.add(i)
+        factory = self.factory()
+        stats.reset()
+        keys = factory.keys()
+        self.assertEqual(3, factory.warm(keys))
+        self.assertEqual(3, len(list(factory.values(keys))))
+        # The mailbox is listed once
+        self.assertEqual(1, stats.timers['list'][0])
+        self.assertEqual(3, stats.counters['stub.hit'])
+        self.assertEqual(3, len(list(factory)))
@@ -1,5 +1,19 @@
+import io
+import json
+import os
+import quopri
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+import contextlib
+import email.utils
 import mimec
+import mimecc
+from unittest import mock
 from email.message import Message
 from email.parser import FeedParser
 
@@ -66,3 +80,415 @@ of a four foot restriction, on humanoid hight
             '<someone@else.org>',
             'Bobby <notbob@theotherdomain.net>'
         ], message.get_all('To'))
+
+    def test_add_to_normalised(self):
+        m = mimec.MimeCompiler(mail('''to: Harold <Harold@OneTwo.com>
+
+'''))
+        m.add_to(['harold@onetwo.com', 'egg@b\xfccher.example', 'egg@b\xfccher.example'])
+        m.add_cc(['harold@onetwo.com'])
+        m.add_to(['Egg <EGG@xn--bcher-kva.example>'])
+        message = m.close()
+        self.assertEqual([
+            'Harold <Harold@OneTwo.com>',
+            'egg@b\xfccher.example'
+        ], message.get_all('To'))
+        self.assertEqual(['harold@onetwo.com'], message.get_all('Cc'))
+
+    def test_fold_recipents(self):
+        m = mimec.MimeCompiler(mail('''to: <harold@onetwo.com>
+
+'''), fold_recipents=True)
+        to = ['user%d@greenmidget.com' % i for i in range(100)]
+        m.add_to(to)
+        m.add_to(['harold@onetwo.com', 'spam <spam@greenmidget.com>'])
+        message = m.close()
+        self.assertEqual(1, len(message.get_all('To')))
+
+        out = io.StringIO()
+        mimec.dump_message(message, out)
+        lines = out.getvalue().split('\n\n')[0].splitlines()
+        self.assertTrue(all(len(l) <= 78 for l in lines))
+
+        addresses = [a for n, a in email.utils.getaddresses(mail(out.getvalue()).get_all('To'))]
+        self.assertEqual(['harold@onetwo.com'] + to + ['spam@greenmidget.com'], addresses)
+
+    def test_attach_file(self):
+        data = bytes(bytearray(range(256))) * 1000
+        with tempfile.NamedTemporaryFile(suffix='.bin') as f:
+            f.write(data)
+            f.flush()
+
+            m = mimec.MimeCompiler(mail('''from: john doe <john@inter.net>
+subject: Hello
+
+see attached'''))
+            m.attach_file(f.name)
+            # Without a cache the file is not hashed
+            self.assertIsNone(m._message.get_payload()[-1].digest)
+            out = io.StringIO()
+            mimec.dump_message(m.close(), out)
+
+        message = mail(out.getvalue())
+        root, text, attachment = list(message.walk())
+        self.assertEqual('see attached', text.get_payload())
+        self.assertEqual('application/octet-stream', attachment.get_content_type())
+        self.assertEqual(data, attachment.get_payload(decode=True))
+        lines = attachment.get_payload().splitlines()
+        self.assertTrue(all(len(l) <= 76 for l in lines))
+
+
+class TestReadFile(unittest.TestCase):
+    def read(self, data):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(data)
+            f.flush()
+            return mimec.read_file(f.name)
+
+    def test_message(self):
+        m = self.read(b'From: john doe <john@inter.net>\nSubject: Hello\n\nbody\n')
+        self.assertIsInstance(m, Message)
+        self.assertEqual('Hello', m['Subject'])
+
+    def test_unixfrom_message(self):
+        m = self.read(b'From john Mon Jan  1 00:00:00 2001\nSubject: Hello\n\nbody\n')
+        self.assertIsInstance(m, Message)
+
+    def test_text(self):
+        data = b'just some text\nwith: a colon\n'
+        self.assertEqual(data, self.read(data))
+
+    def test_binary(self):
+        data = b'Subject: \0\xff' + bytes(bytearray(range(256)))
+        self.assertEqual(data, self.read(data))
+
+
+class TestEncoding(unittest.TestCase):
+    def attach(self, data, mime='text/plain', allow_8bit=False, check=True):
+        m = mimec.MimeCompiler(Message(), allow_8bit=allow_8bit)
+        m.attach('file', data, mime=mime)
+        out = io.StringIO()
+        mimec.dump_message(m.close(), out)
+        part = list(mail(out.getvalue()).walk())[-1]
+        if check:
+            self.assertEqual(data, part.get_payload(decode=True))
+        else:
+            self.assertEqual(data.decode('utf-8'), part.get_payload())
+        self.part = part
+        return part['Content-Transfer-Encoding']
+
+    def test_7bit(self):
+        self.assertEqual(None, self.attach(b'plain ascii\ntext\n'))
+
+    def test_8bit(self):
+        data = (u'Sm\xf6rg\xe5s with a mostly ascii sentence around it\n' * 3).encode('utf-8')
+        self.assertEqual('quoted-printable', self.attach(data))
+        self.assertEqual('utf-8', self.part.get_param('charset'))
+        self.assertEqual('8bit', self.attach(data, allow_8bit=True, check=False))
+        self.assertEqual('utf-8', self.part.get_param('charset'))
+
+    def test_charset(self):
+        self.attach(b'plain ascii\n')
+        self.assertEqual(None, self.part.get_param('charset'))
+        self.attach(u'Sm\xf6rg\xe5s\n'.encode('latin-1'))
+        self.assertEqual(None, self.part.get_param('charset'))
+        self.attach(u'Sm\xf6rg\xe5s\n'.encode('utf-8'), mime='application/octet-stream')
+        self.assertEqual(None, self.part.get_param('charset'))
+
+    def test_from_line(self):
+        data = u'Hej d\xe5\nFrom here on\n'.encode('utf-8')
+        self.assertEqual('quoted-printable', self.attach(data))
+
+        with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+            f.write(data)
+            f.flush()
+            compiled = []
+            for stream in (False, True):
+                m = mimec.MimeCompiler(Message())
+                if stream:
+                    m.attach_file(f.name)
+                else:
+                    m.attach(f.name, data)
+                out = io.StringIO()
+                mimec.dump_message(m.close(), out)
+                compiled.append(list(mail(out.getvalue()).walk())[-1].get_payload())
+        self.assertEqual(compiled[0], compiled[1])
+        self.assertIn('\n=46rom here on\n', compiled[0])
+
+    def test_qp_line_length(self):
+        for data in (b'x' * 72 + b'=\t\n', b'x' * 73 + b'\xe5\xe5\n', b'x' * 300 + b' \n',
+                     b'x' * 74 + b'From here\n'):
+            encoded = mimec.encode_qp(data)
+            self.assertTrue(all(len(line) <= 76 for line in encoded.split(b'\n')), encoded)
+            self.assertFalse(any(line.startswith(b'From ') for line in encoded.split(b'\n')))
+            self.assertEqual(data, quopri.decodestring(encoded))
+
+    def test_long_lines(self):
+        self.assertEqual('quoted-printable', self.attach(b'x' * 2000 + b'\n'))
+
+    def test_binary(self):
+        data = bytes(bytearray(range(256))) * 4
+        self.assertEqual('base64', self.attach(data))
+        self.assertEqual('base64', self.attach(data, mime='application/octet-stream'))
+
+    def test_streamed(self):
+        data = u'l\xe5ng rad ' * 1000 + u'\n\xe5\n'
+        data = data.encode('latin-1') * 100
+        with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+            f.write(data)
+            f.flush()
+            m = mimec.MimeCompiler(Message())
+            m.attach_file(f.name)
+            out = io.StringIO()
+            mimec.dump_message(m.close(), out)
+
+        part = list(mail(out.getvalue()).walk())[-1]
+        self.assertEqual('quoted-printable', part['Content-Transfer-Encoding'])
+        self.assertEqual(data, part.get_payload(decode=True))
+        lines = part.get_payload().splitlines()
+        self.assertTrue(all(len(l) <= 76 for l in lines))
+
+
+class TestStructureScanner(unittest.TestCase):
+    message = b'''From: john doe <john@inter.net>
+Subject: nested
+Content-Type: multipart/mixed; boundary="outer"
+
+preamble
+--outer
+Content-Type: text/plain
+
+first part
+--outer
+Content-Type: multipart/alternative; boundary="inner"
+
+--inner\r
+Content-Type: text/plain\r
+\r
+inner -- text\r
+--inner\r
+Content-Type: text/html\r
+\r
+<p>inner</p>\r
+--inner--\r
+--outer
+Content-Type: message/rfc822
+
+Subject: forwarded
+
+forwarded body
+--outer--
+epilogue
+'''
+
+    def scan(self, chunk_size):
+        old, mimec.CHUNK_SIZE = mimec.CHUNK_SIZE, chunk_size
+        try:
+            return mimec.StructureScanner().scan(io.BytesIO(self.message))
+        finally:
+            mimec.CHUNK_SIZE = old
+
+    def test_scan(self):
+        for chunk_size in (3, 7, 64, 4096):
+            parts = self.scan(chunk_size)
+            self.assertEqual([
+                (0, 'multipart/mixed'),
+                (1, 'text/plain'),
+                (1, 'multipart/alternative'),
+                (2, 'text/plain'),
+                (2, 'text/html'),
+                (1, 'message/rfc822'),
+                (2, 'text/plain'),
+            ], [(p['depth'], p['content_type']) for p in parts])
+
+            bodies = [self.message[p['body_offset']:p['body_offset'] + p['size']]
+                      for p in parts]
+            self.assertEqual(b'first part', bodies[1])
+            self.assertEqual(b'inner -- text', bodies[3])
+            self.assertEqual(b'<p>inner</p>', bodies[4])
+            self.assertEqual(b'forwarded body', bodies[6])
+            self.assertEqual([('Subject', 'forwarded')], parts[6]['headers'])
+            self.assertEqual(len(self.message), parts[0]['body_offset'] + parts[0]['size'])
+
+    def test_info_modified(self):
+        with tempfile.NamedTemporaryFile(suffix='.txt') as f:
+            f.write(b'attached\n' * 1000)
+            f.flush()
+            args = mimec.get_argparser().parse_args(
+                ['--info', '--subject', 'info', '--attach', f.name])
+            # The attachment is streamed rather than read in memory
+            with mock.patch.object(mimec, 'read_file', side_effect=AssertionError):
+                parts = mimec.info(args)
+        self.assertEqual(['multipart/mixed', 'text/plain', 'text/plain'],
+                         [p['content_type'] for p in parts])
+        self.assertEqual(9000, parts[2]['size'])
+        self.assertFalse(args.stream)
+        # The compiled message is gone so there are no offsets into it
+        self.assertEqual([(None, None)] * 3, [(p['offset'], p['body_offset']) for p in parts])
+        out = io.StringIO()
+        mimec.print_info(parts, out=out)
+        self.assertIn('part of type text/plain (9000 bytes)\n', out.getvalue())
+
+
+class TestAttachmentCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = mimec.AttachmentCache(os.path.join(self.dir, 'cache'))
+        self.path = os.path.join(self.dir, 'data.bin')
+        with open(self.path, 'wb') as f:
+            f.write(bytes(bytearray(range(256))) * 100)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def compile(self):
+        m = mimec.MimeCompiler(Message(), cache=self.cache)
+        m.attach_file(self.path)
+        out = io.StringIO()
+        mimec.dump_message(m.close(), out)
+        return list(mail(out.getvalue()).walk())[-1]
+
+    def test_reuse(self):
+        self.compile()
+        key = self.cache.file_key(self.path, 'application/octet-stream', False)
+        digest, cte, charset = self.cache.lookup(key)
+        self.assertEqual(('base64', None), (cte, charset))
+
+        # A cached body is used as is without reading the file
+        with self.cache.store(digest, cte) as f:
+            f.write('Y2FjaGVk\n')
+        self.assertEqual(b'cached', self.compile().get_payload(decode=True))
+
+    def test_evict(self):
+        self.cache.max_size = 10
+        self.compile()
+        self.assertEqual([], [n for n in os.listdir(os.path.join(self.dir, 'cache', 'bodies'))
+                              if not n.startswith('.')])
+        self.assertEqual(
+            open(self.path, 'rb').read(), self.compile().get_payload(decode=True))
+
+
+class TestCompileServer(unittest.TestCase):
+    def request(self, argv, stdin=b''):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        with sock:
+            request = {'argv': argv, 'cwd': self.dir}
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n' + stdin)
+            sock.shutdown(socket.SHUT_WR)
+            f = sock.makefile('rb')
+            return json.loads(f.readline().decode('utf-8')), f.read()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'mimec.sock')
+        self.server = mimec.CompileServer(self.path, mimec.CompileRequestHandler)
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir)
+
+    def test_compile(self):
+        reply, data = self.request(['-', '--subject', 'served'], b'to: someone@else.org\n\nhi\n')
+        self.assertEqual({'status': 0, 'error': None}, reply)
+        message = mail(data.decode('utf-8'))
+        self.assertEqual('served', message['Subject'])
+        self.assertEqual('hi\n', message.get_payload())
+
+    def test_errors(self):
+        reply, data = self.request(['--bogus'])
+        self.assertEqual(2, reply['status'])
+        reply, data = self.request(['missing.eml'])
+        self.assertEqual(1, reply['status'])
+        self.assertEqual(b'', data)
+        reply, data = self.request(['--serve'])
+        self.assertEqual(2, reply['status'])
+
+    def test_serve_argument(self):
+        with mock.patch.dict(os.environ, clear=True):
+            parser = mimec.get_argparser()
+        self.assertEqual('', parser.parse_args(['--serve']).serve)
+        self.assertEqual('x.sock', parser.parse_args(['--serve', 'x.sock']).serve)
+        self.assertIsNone(parser.parse_args([]).serve)
+
+    def test_client_local(self):
+        self.assertTrue(mimecc.is_local(['--batch', 'manifest']))
+        self.assertTrue(mimecc.is_local(['--batch=manifest']))
+        self.assertTrue(mimecc.is_local(['--serve']))
+        self.assertTrue(mimecc.is_local(['-h']))
+        self.assertFalse(mimecc.is_local(['-', '--subject', 'serve']))
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.body = os.path.join(self.dir, 'body.txt')
+        with open(self.body, 'w') as f:
+            f.write('Hello\n')
+        self.output = os.path.join(self.dir, 'out')
+        self.manifest = os.path.join(self.dir, 'manifest.jsonl')
+        self.write_manifest([
+            {'parts': [self.body], 'subject': 'one', 'to': 'a@there.org'},
+            None,
+            {'parts': self.body, 'subject': 'three',
+             'output': os.path.join(self.dir, 'three.eml')},
+            {'parts': [os.path.join(self.dir, 'missing.txt')]},
+            'not json',
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_manifest(self, items):
+        with open(self.manifest, 'w') as f:
+            for item in items:
+                if item is None:
+                    f.write('\n')
+                elif isinstance(item, str):
+                    f.write(item + '\n')
+                else:
+                    f.write(json.dumps(item) + '\n')
+
+    def batch(self, jobs):
+        args = mimec.get_argparser().parse_args([
+            '--batch', self.manifest, '--jobs', str(jobs), '--output-dir', self.output])
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            failed = mimec.batch(args)
+        return failed, err.getvalue().splitlines()
+
+    def check_batch(self, jobs):
+        failed, err = self.batch(jobs)
+        self.assertEqual(2, failed)
+        self.assertEqual(['1.eml'], os.listdir(self.output))
+        with open(os.path.join(self.output, '1.eml')) as f:
+            message = mail(f.read())
+        self.assertEqual('one', message['Subject'])
+        self.assertEqual('a@there.org', message['To'])
+        with open(os.path.join(self.dir, 'three.eml')) as f:
+            self.assertEqual('three', mail(f.read())['Subject'])
+
+        errors = sorted(line for line in err if line.startswith(self.manifest))
+        self.assertEqual(2, len(errors))
+        self.assertTrue(errors[0].startswith(self.manifest + ':4: FileNotFoundError'))
+        self.assertTrue(errors[1].startswith(self.manifest + ':5: JSONDecodeError'))
+        self.assertTrue(err[-1].startswith('compiled 2 of 4 messages (2 failed'))
+
+    def test_batch(self):
+        self.check_batch(1)
+
+    def test_batch_workers(self):
+        self.check_batch(2)
+
+    def test_exit_status(self):
+        def run(jobs):
+            return subprocess.call(
+                [sys.executable, mimec.__file__, '--batch', self.manifest,
+                 '--jobs', str(jobs), '--output-dir', self.output],
+                stderr=subprocess.DEVNULL)
+
+        self.assertEqual(1, run(2))
+        self.write_manifest([{'parts': [self.body], 'subject': 'one'}])
+        self.assertEqual(0, run(1))
@@ -0,0 +1,375 @@
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import random
+import mailbox
+import unittest
+import threader
+from threader import message
+
+
+def shape(container):
+    '''Get a (id, sorted children) tree of a container'''
+    return (container.message.id,
+            sorted(shape(c) for c in container.children))
+
+
+def ids_of(container):
+    stack = [container]
+    while stack:
+        container = stack.pop()
+        yield container.id
+        stack.extend(container.children)
+
+
+class TestThread(unittest.TestCase):
+    def test_thread(self):
+        roots = threader.thread([
+            message('<1>', subject='Hello'),
+            message('<2>', subject='Re: Hello', ref=('<1>',)),
+            message('<3>', subject='Re: Hello', ref=('<1>', '<2>')),
+            message('<4>', subject='Re: Hello', ref=('<1>',)),
+            message('<5>', subject='Other'),
+        ])
+        self.assertEqual([
+            ('<1>', [('<2>', [('<3>', [])]), ('<4>', [])]),
+            ('<5>', [])
+        ], sorted(shape(r) for r in roots))
+
+    def test_placeholder(self):
+        roots = threader.thread([
+            message('<2>', subject='Re: Hello', ref=('<1>',)),
+            message('<3>', subject='Re: Hello', ref=('<1>',)),
+            message('<5>', subject='Re: Other', ref=('<4>',)),
+        ])
+        self.assertEqual([
+            ('<1>', [('<2>', []), ('<3>', [])]),
+            ('<5>', [])
+        ], sorted(shape(r) for r in roots))
+
+    def test_reply_before_parent(self):
+        roots = threader.thread([
+            message('<d>', subject='T', ref=('<p>', '<c>')),
+            message('<c>', subject='T', ref=('<p>',)),
+        ])
+        self.assertEqual([('<c>', [('<d>', [])])], [shape(r) for r in roots])
+
+    def test_loop(self):
+        roots = threader.thread([
+            message('<1>', subject='A', ref=('<2>',)),
+            message('<2>', subject='B', ref=('<1>',)),
+            message('<3>', subject='C', ref=('<3>',)),
+        ])
+        self.assertEqual([
+            ('<2>', [('<1>', [])]),
+            ('<3>', [])
+        ], sorted(shape(r) for r in roots))
+
+    def test_merge_subjects(self):
+        roots = threader.thread([
+            message('<1>', subject='Hello', date=1),
+            # A reply whose parent is missing joins the thread of <1>
+            message('<3>', subject='Hello', ref=('<2>',), date=3),
+            # Two placeholders with the same subject are merged
+            message('<5>', subject='Other', ref=('<4>',), date=5),
+            message('<6>', subject='Other', ref=('<4>',), date=6),
+            message('<8>', subject='Other', ref=('<7>',), date=8),
+            message('<9>', subject='Other', ref=('<7>',), date=9),
+            # Neither a reply, gathered under a new placeholder
+            message('<10>', subject='Third', date=10),
+            message('<11>', subject='Third', date=11),
+        ])
+        self.assertEqual([
+            ('<1>', [('<3>', [])]),
+            ('<4>', [('<5>', []), ('<6>', []), ('<8>', []), ('<9>', [])]),
+            ('<10>', [('<10>', []), ('<11>', [])]),
+        ], [(r.message.id, [shape(c) for c in r.children]) for r in roots])
+        self.assertTrue(roots[2].is_placeholder)
+        self.assertEqual('Third', threader._subject(roots[2]))
+
+    def test_sort(self):
+        roots = threader.thread([
+            message('<1>', subject='A', date=30),
+            message('<2>', subject='B', date=10),
+            message('<3>', subject='Re: B', ref=('<2>',), date=50),
+            message('<4>', subject='Re: B', ref=('<2>',), date=20),
+            message('<5>', subject='Re: B', ref=('<2>',), date=20),
+            message('<7>', subject='C', ref=('<6>',), date=40),
+            message('<8>', subject='C', ref=('<6>',), date=25),
+        ])
+        self.assertEqual(['<2>', '<6>', '<1>'], [r.message.id for r in roots])
+        self.assertEqual(['<4>', '<5>', '<3>'], [c.message.id for c in roots[0].children])
+        self.assertEqual(['<8>', '<7>'], [c.message.id for c in roots[1].children])
+
+    def test_deep(self):
+        count = 100000
+        messages = [message('<0>', subject='Deep')] + [
+            message('<%d>' % i, subject='Re: Deep', ref=('<%d>' % (i - 1),))
+            for i in range(1, count)
+        ]
+        start = time.time()
+        root, = threader.thread(messages)
+        self.assertLess(time.time() - start, 10)
+
+        depth = 0
+        while root.children:
+            root, = root.children
+            depth += 1
+        self.assertEqual(count - 1, depth)
+
+    def test_deep_reversed(self):
+        count = 100000
+        messages = [
+            message('<%d>' % i, subject='Re: Deep', ref=('<%d>' % (i - 1),))
+            for i in range(count - 1, 0, -1)
+        ]
+        root, = threader.thread(messages)
+        self.assertEqual('<1>', root.message.id)
+
+    def test_dump_deep(self):
+        count = 5000
+        root, = threader.thread(
+            message('<%d>' % i, subject='Deep', ref=('<%d>' % (i - 1),) if i else ())
+            for i in range(count))
+        lines = []
+        root.dump(lines.append)
+        self.assertEqual(2 * count, len(lines))
+        self.assertEqual('\t' * (count - 1) + 'Id: <%d>' % (count - 1), lines[-2])
+
+    def test_compact(self):
+        table = threader.Table()
+        table.add_message(message('<2>', subject='Re: Hello', ref=('<1>',)))
+        placeholder, container = table['<1>'], table['<2>']
+        self.assertFalse(hasattr(container, '__dict__'))
+        self.assertEqual('<1>', placeholder._message)
+        self.assertTrue(placeholder.is_placeholder)
+        self.assertEqual(message('<1>'), placeholder.message)
+        self.assertIsNone(container._children)
+        self.assertEqual((), container.children)
+
+    def test_wide(self):
+        count = 100000
+        messages = [message('<0>', subject='Wide')] + [
+            message('<%d>' % i, subject='Re: Wide', ref=('<0>',))
+            for i in range(1, count)
+        ]
+        root, = threader.thread(messages)
+        self.assertEqual(count - 1, len(root.children))
+
+
+class TestThreader(unittest.TestCase):
+    def setUp(self):
+        self.threader = threader.Threader()
+
+    def test_roots_sorted(self):
+        self.threader.add_messages([
+            message('<1>', subject='A', date=3),
+            message('<2>', subject='B', date=1),
+            message('<4>', subject='C', ref=('<3>',), date=2),
+            message('<5>', subject='C', ref=('<3>',), date=4),
+        ])
+        self.assertEqual(['<2>', '<3>', '<1>'], [r.message.id for r in self.threader.roots])
+
+    def ids(self, roots):
+        return sorted(r.message.id for r in roots)
+
+    def test_add(self):
+        diff = self.threader.add_messages([
+            message('<1>', subject='Hello'),
+            message('<3>', subject='Other'),
+        ])
+        self.assertEqual(['<1>', '<3>'], self.ids(diff.added))
+
+        diff = self.threader.add_messages([
+            message('<2>', subject='Re: Hello', ref=('<1>',)),
+        ])
+        self.assertEqual(([], ['<1>'], []),
+                         (diff.added, self.ids(diff.changed), diff.removed))
+        self.assertEqual([('<1>', [('<2>', [])]), ('<3>', [])],
+                         sorted(shape(r) for r in self.threader.roots))
+
+    def test_join_threads(self):
+        self.threader.add_messages([
+            message('<2>', subject='Re: Hello', ref=('<1>',)),
+            message('<3>', subject='Re: Hello', ref=('<1>', '<2>')),
+            message('<5>', subject='Re: Hello', ref=('<4>',)),
+        ])
+        self.assertEqual(['<2>', '<5>'], self.ids(self.threader.roots))
+
+        # <4> joins the thread of <5> to the one of <1>
+        diff = self.threader.add_messages([
+            message('<4>', subject='Re: Hello', ref=('<1>',)),
+        ])
+        self.assertEqual((['<1>'], [], ['<2>', '<5>']),
+                         (self.ids(diff.added), diff.changed, sorted(diff.removed)))
+        self.assertEqual([('<1>', [('<2>', [('<3>', [])]), ('<4>', [('<5>', [])])])],
+                         [shape(r) for r in self.threader.roots])
+
+    def test_remove(self):
+        self.threader.add_messages([
+            message('<1>', subject='Hello'),
+            message('<2>', subject='Re: Hello', ref=('<1>',)),
+            message('<3>', subject='Re: Hello', ref=('<1>', '<2>')),
+            message('<4>', subject='Other'),
+        ])
+        diff = self.threader.remove_messages(['<2>'])
+        self.assertEqual(([], ['<1>'], []),
+                         (diff.added, self.ids(diff.changed), diff.removed))
+        self.assertEqual([('<1>', [('<3>', [])]), ('<4>', [])],
+                         sorted(shape(r) for r in self.threader.roots))
+
+        diff = self.threader.remove_messages(['<1>', '<4>'])
+        self.assertEqual((['<3>'], [], ['<1>', '<4>']),
+                         (self.ids(diff.added), diff.changed, sorted(diff.removed)))
+
+        diff = self.threader.remove_messages(['<3>'])
+        self.assertEqual(([], [], ['<3>']), diff)
+        self.assertEqual([], self.threader.roots)
+        self.assertEqual({}, self.threader._table)
+
+    def assertSameAsThread(self, messages):
+        expected = [r for r in threader.thread(messages)
+                    if not (r.is_placeholder and not r.children)]
+        self.assertEqual(sorted(shape(r) for r in expected),
+                         sorted(shape(r) for r in self.threader.roots))
+
+    def test_remove_rebuilds_other_threads(self):
+        messages = [
+            message('<0>', subject='A', ref=('<1>',)),
+            message('<1>', subject='B', ref=('<0>', '<2>')),
+            message('<2>', subject='C', ref=('<3>',)),
+            message('<3>', subject='D'),
+        ]
+        for m in messages:
+            self.threader.add_messages([m])
+        self.threader.remove_messages(['<0>'])
+        self.assertSameAsThread(messages[1:])
+        self.assertEqual([('<3>', [('<2>', [('<1>', [])])])],
+                         [shape(r) for r in self.threader.roots])
+
+    def test_remove_same_as_thread(self):
+        for seed in range(200):
+            rnd = random.Random(seed)
+            count = rnd.randint(3, 12)
+            self.threader = threader.Threader()
+            live = []
+            for i in range(count):
+                refs = tuple('<%d>' % rnd.randrange(count + 3)
+                             for _ in range(rnd.randint(0, 3)))
+                live.append(message('<%d>' % i, subject='S%d' % i, ref=refs))
+                self.threader.add_messages(live[-1:])
+                if rnd.random() < 0.4:
+                    removed = live.pop(rnd.randrange(len(live)))
+                    self.threader.remove_messages([removed.id])
+            self.assertSameAsThread(live)
+
+    def test_same_as_thread(self):
+        messages = [
+            message('<%d>' % i, subject='Re: %d' % (i % 7),
+                    ref=tuple('<%d>' % r for r in range(i % 7, i, 7)[-3:]))
+            for i in range(200)
+        ]
+        # Later messages move earlier ones to another parent
+        messages += [
+            message('<m%d>' % i, subject='Re: moved %d' % i,
+                    ref=('<x%d>' % i, '<%d>' % (i * 7 + 3)))
+            for i in range(20)
+        ]
+        for m in messages[:150]:
+            self.threader.add_messages([m])
+        self.threader.add_messages(messages[150:210])
+        for m in messages[210:]:
+            self.threader.add_messages([m])
+        expected = threader.Threader()
+        expected.add_messages(messages)
+        self.assertEqual(sorted(shape(r) for r in expected.roots),
+                         sorted(shape(r) for r in self.threader.roots))
+        ids = [i for r in self.threader.roots for i in ids_of(r)]
+        self.assertEqual(len(ids), len(set(ids)))
+
+    def test_move_to_other_thread(self):
+        self.threader.add_messages([
+            message('<b>', subject='B', ref=('<p>',)),
+            message('<c>', subject='C', ref=('<p>',)),
+        ])
+        self.threader.add_messages([
+            message('<m>', subject='M', ref=('<x>', '<b>')),
+        ])
+        self.assertEqual([('<b>', [('<m>', [])]), ('<c>', [])],
+                         sorted(shape(r) for r in self.threader.roots))
+
+
+class TestFolders(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def maildir(self, name, *messages):
+        maildir = mailbox.Maildir(os.path.join(self.dir, name))
+        for headers in messages:
+            maildir.add(''.join('%s: %s\n' % h for h in headers) + '\nbody\n')
+        return maildir._path
+
+    def test_pickle(self):
+        table = threader.Table()
+        for i in range(5000):
+            table.add_message(message('<%d>' % i, subject='Deep', ref=('<%d>' % (i - 1),)))
+        copy = pickle.loads(pickle.dumps(table, 2))
+        self.assertEqual(sorted(table), sorted(copy))
+        self.assertEqual('<4998>', copy['<4999>']._parent.id)
+        root, = threader.thread_table(copy)
+        self.assertEqual('<0>', root.id)
+
+    def test_merge(self):
+        inbox = self.maildir(
+            'INBOX',
+            [('Message-Id', '<1@a>'), ('Subject', 'Hello'),
+             ('Date', 'Mon, 1 Jun 2015 12:00:00 +0000')],
+            [('Message-Id', '<3@a>'), ('Subject', 'Re: Hello'),
+             ('References', '<1@a> <2@b>'), ('Date', 'Mon, 1 Jun 2015 14:00:00 +0000')])
+        sent = self.maildir(
+            'Sent',
+            [('Message-Id', '<2@b>'), ('Subject', 'Re: Hello'),
+             ('In-Reply-To', '<1@a>'), ('Date', 'Mon, 1 Jun 2015 13:00:00 +0000')])
+
+        from threader.__main__ import read_folders
+        tables = read_folders([inbox, sent], jobs=2)
+        self.assertEqual(['<1@a>', '<2@b>', '<3@a>'], sorted(tables[0]))
+        self.assertTrue(tables[0]['<2@b>'].is_placeholder)
+
+        tables[0].merge(tables[1])
+        roots = threader.thread_table(tables[0])
+        self.assertEqual([('<1@a>', [('<2@b>', [('<3@a>', [])])])], [shape(r) for r in roots])
+
+    def test_thread_folders(self):
+        inbox = self.maildir(
+            'INBOX',
+            [('Message-Id', '<1@a>'), ('Subject', 'Hello'),
+             ('Date', 'Mon, 1 Jun 2015 12:00:00 +0000')],
+            [('Message-Id', '<3@a>'), ('Subject', 'Re: Hello'),
+             ('References', '<1@a> <2@b>'), ('Date', 'Mon, 1 Jun 2015 14:00:00 +0000')],
+            [('Message-Id', '<4@a>'), ('Subject', 'Other'),
+             ('Date', 'Mon, 1 Jun 2015 15:00:00 +0000')])
+        deep = self.maildir(
+            'Deep',
+            *[[('Message-Id', '<%d@d>' % i), ('Subject', 'Deep'),
+               ('In-Reply-To', '<%d@d>' % (i - 1))] for i in range(2000)])
+
+        from threader.__main__ import thread_folders
+        inbox_roots, deep_roots = thread_folders([inbox, deep], jobs=2)
+        # The missing <2@b> is pruned by the worker
+        self.assertEqual([('<1@a>', [('<3@a>', [])]), ('<4@a>', [])],
+                         [shape(r) for r in inbox_roots])
+        self.assertIsNone(inbox_roots[0]._parent)
+        self.assertIs(inbox_roots[0], inbox_roots[0].children[0]._parent)
+
+        root, = deep_roots
+        depth = 0
+        while root.children:
+            root, = root.children
+            depth += 1
+        self.assertEqual(('<1999@d>', 1999), (root.id, depth))
@@ -12,18 +12,49 @@ except ImportError:
     cooperate = lambda: None
 
 
+Message = collections.namedtuple('Message', ('id', 'subject', 'ref', 'date'))
+
 message = functools.partial(
-    collections.namedtuple('Message', ('id', 'subject', 'ref')),
+    Message,
     subject=None,
-    ref=()
+    ref=(),
+    date=None
 )
 
 
 class Container(object):
+    '''A message, or the id of a missing message, in a thread
+
+    Children are kept in a list created with the first child, most
+    containers have none or one. A placeholder only keeps the id of the
+    missing message.
+    '''
+    __slots__ = ('_message', '_parent', '_children')
+
     def __init__(self, message):
-        self.message = message
+        self._message = message
         self._parent = None
-        self._children = set()
+        self._children = None
+
+    @property
+    def message(self):
+        if isinstance(self._message, tuple):
+            return self._message
+        return message(self._message)
+
+    @message.setter
+    def message(self, value):
+        self._message = value
+
+    @property
+    def id(self):
+        if isinstance(self._message, tuple):
+            return self._message.id
+        return self._message
+
+    @property
+    def children(self):
+        return self._children or ()
 
     @property
     def is_root(self):
@@ -31,51 +62,76 @@ class Container(object):
 
     @property
     def is_placeholder(self):
-        return self.message.subject is None
+        return not isinstance(self._message, tuple) or self._message.subject is None
 
     def can_reach(self, other):
+        '''Check if `other` is a descendant, by walking up from `other`'''
         assert self is not other
-        if other in self._children:
-            return True
-        return any(c.can_reach(other) for c in self._children)
+        parent = other._parent
+        while parent is not None:
+            if parent is self:
+                return True
+            parent = parent._parent
+        return False
 
     def prune(self):
-        newchildren = set()
-        for c in self._children:
-            assert c._parent is self, '%r not parent of %r' % (self, c)
-            newchildren.update(c.prune())
-        self._children = newchildren
+        '''Remove placeholders from the tree, returns the containers replacing self'''
+        replacements = {}
+        stack = [(self, False)]
+        while stack:
+            container, visited = stack.pop()
+            if not visited:
+                stack.append((container, True))
+                stack.extend((c, False) for c in container.children)
+                continue
 
-        if self.is_placeholder:
-            if self._parent is None and len(self._children) != 1:
-                return [self]
+            newchildren = []
+            for c in container.children:
+                assert c._parent is container, '%r not parent of %r' % (container, c)
+                newchildren.extend(replacements.pop(c))
+            for c in newchildren:
+                c._parent = container
+            container._children = newchildren or None
 
-            return newchildren
-
-        return [self]
+            if (container.is_placeholder
+                    and not (container._parent is None and len(newchildren) != 1)):
+                replacements[container] = newchildren
+            else:
+                replacements[container] = (container,)
+        return replacements[self]
 
     def add_child(self, other):
-        if self.can_reach(other) or other.can_reach(self):
+        if other is self or other._parent is self:
+            return
+        # Only a container with children can be an ancestor
+        if self.can_reach(other) or (other._children and other.can_reach(self)):
             #print('would loop %r => %r' % (self, other))
             return
         if other._parent is not None:
-            other._parent._children.remove(other)
-        self._children.add(other)
+            siblings = other._parent._children
+            siblings.remove(other)
+            if not siblings:
+                other._parent._children = None
+        if self._children is None:
+            self._children = [other]
+        else:
+            self._children.append(other)
         other._parent = self
 
     def dump(self, print=print, level=0):
-        padding = '\t' * level
-        if self.is_placeholder:
-            print('%s[Placeholder %s]' % (padding, self.message.id))
-        else:
-            print('%sId: %s' % (padding, self.message.id))
-            print('%sSubject: %s' % (padding, self.message.subject))
-
-        for c in self._children:
-            c.dump(print, level + 1)
+        stack = [(self, level)]
+        while stack:
+            container, level = stack.pop()
+            padding = '\t' * level
+            if container.is_placeholder:
+                print('%s[Placeholder %s]' % (padding, container.id))
+            else:
+                print('%sId: %s' % (padding, container.id))
+                print('%sSubject: %s' % (padding, container._message.subject))
+            stack.extend((c, level + 1) for c in reversed(list(container.children)))
 
     def __repr__(self):
-        return '<Container (of %r)>' % self.message.id
+        return '<Container (of %r)>' % self.id
 
 
 class Table(dict):
@@ -86,20 +142,20 @@ class Table(dict):
                 yield v
 
     def placeholder(self, message_id):
-        return Container(message(message_id))
+        return Container(message_id)
 
     def add_message(self, message):
-        try:
-            container = self[message.id]
-            if container.is_placeholder:
-                container.message = message
-        except KeyError as e:
-            container = Container(message)
-            self[message.id] = container
+        container = self.get(message.id)
+        if container is None:
+            container = self[message.id] = Container(message)
+        elif container.is_placeholder:
+            container.message = message
 
         lastc = None
         for ref in message.ref:
-            rcontainer = self.setdefault(ref, self.placeholder(ref))
+            rcontainer = self.get(ref)
+            if rcontainer is None:
+                rcontainer = self[ref] = self.placeholder(ref)
             if lastc is not None:
                 lastc.add_child(rcontainer)
             lastc = rcontainer
@@ -107,17 +163,317 @@ class Table(dict):
         if lastc is not None:
             lastc.add_child(container)
 
+    def merge(self, other):
+        '''Add the containers and links of the table `other`
+
+        A link in `other` only moves a container already linked here when
+        `other` has the message and this table only a placeholder for it.
+        '''
+        moved = set()
+        for key, container in other.items():
+            own = self.get(key)
+            if own is None:
+                self[key] = Container(container._message)
+            elif own.is_placeholder and not container.is_placeholder:
+                own.message = container._message
+                moved.add(key)
+        for key, container in other.items():
+            if container._parent is None:
+                continue
+            own = self[key]
+            if own._parent is None or key in moved:
+                self[container._parent.id].add_child(own)
+            cooperate()
+
+    def __reduce__(self):
+        # Pickled flat as deep threads would exceed the recursion limit
+        return _restore_table, ([
+            (key, c._message, c._parent.id if c._parent is not None else None)
+            for key, c in self.items()
+        ],)
+
+
+def _restore_table(items):
+    table = Table()
+    for key, message, _ in items:
+        table[key] = Container(message)
+    for key, _, parent in items:
+        if parent is not None:
+            container, parent = table[key], table[parent]
+            container._parent = parent
+            if parent._children is None:
+                parent._children = [container]
+            else:
+                parent._children.append(container)
+    return table
+
+
+def thread_table(table):
+    '''Prune, merge by subject and sort the threads of `table`, returns the roots'''
+    # Pruning detaches promoted children, which must not be taken as roots
+    result = []
+    for c in list(table.root_set):
+        nc, = c.prune()
+        nc._parent = None
+        result.append(nc)
+    return sort_threads(merge_subjects(result))
+
 
 def thread(messages):
     table = Table()
     for message in messages:
         table.add_message(message)
         cooperate()
+    return thread_table(table)
 
-    result = []
-    for c in table.root_set:
-        nc, = c.prune()
-        ## subject merge
-        ## sorting
-        result.append(nc)
-    return result
+
+def _subject(container):
+    if container.is_placeholder:
+        if not container._children:
+            return None
+        container = min(container._children, key=lambda c: c.id or '')
+        if container.is_placeholder:
+            return None
+    return container._message.subject
+
+
+def _is_reply(container):
+    # The subjects are normalised so a message with references is taken as a reply
+    return isinstance(container._message, tuple) and bool(container._message.ref)
+
+
+def merge_subjects(roots):
+    '''Gather the roots with the same subject in one thread
+
+    Returns the new list of roots.
+    '''
+    # Pick the root the others are merged into for each subject, preferring
+    # placeholders and then messages that are not replies
+    table = {}
+    for root in roots:
+        subject = _subject(root)
+        if not subject:
+            continue
+        other = table.get(subject)
+        if (other is None
+                or (root.is_placeholder and not other.is_placeholder)
+                or (not other.is_placeholder and _is_reply(other) and not _is_reply(root))):
+            table[subject] = root
+
+    merged = set()
+    added = []
+    for root in roots:
+        subject = _subject(root)
+        other = table.get(subject) if subject else None
+        if other is None or other is root:
+            continue
+        if other.is_placeholder and root.is_placeholder:
+            for c in list(root._children):
+                other.add_child(c)
+            merged.add(root)
+        elif other.is_placeholder or (_is_reply(root) and not _is_reply(other)):
+            other.add_child(root)
+            merged.add(root)
+        else:
+            # Neither is a reply of the other, make them siblings under a
+            # placeholder that takes the id of the first one
+            parent = Container(other.id)
+            parent.add_child(other)
+            parent.add_child(root)
+            table[subject] = parent
+            merged.update((other, root))
+            added.append(parent)
+    return [r for r in roots if r not in merged] + [r for r in added if r not in merged]
+
+
+def _sort_key(container, dates):
+    return (dates[container] or 0, container.id or '')
+
+
+def sort_threads(roots, dates=None):
+    '''Order the threads and the children of each container by date
+
+    A placeholder has the date of its earliest child, equal dates are
+    ordered by Message-Id. The children become lists, returns the sorted
+    list of roots. The date of each container is stored in `dates` if given.
+    '''
+    if dates is None:
+        dates = {}
+    stack = [(r, False) for r in roots]
+    while stack:
+        container, visited = stack.pop()
+        if not visited:
+            stack.append((container, True))
+            stack.extend((c, False) for c in container.children)
+            continue
+        date = container._message.date if isinstance(container._message, tuple) else None
+        if date is None:
+            children = [dates[c] for c in container.children if dates[c] is not None]
+            date = min(children) if children else None
+        dates[container] = date
+        if container._children:
+            container._children = sorted(
+                container._children, key=lambda c: _sort_key(c, dates))
+    return sorted(roots, key=lambda r: _sort_key(r, dates))
+
+
+Diff = collections.namedtuple('Diff', ('added', 'changed', 'removed'))
+
+
+class Threader(object):
+    '''Thread messages incrementally
+
+    The container table is kept between batches of added and removed
+    messages, and only the threads they touch are pruned again. Each batch
+    returns a `Diff` of the pruned roots added and changed, and the ids of
+    the roots removed. Threads are sorted like by `thread` but not merged by
+    subject.
+    '''
+
+    def __init__(self):
+        self._table = Table()
+        # Order the messages were added in, to rebuild threads the same way
+        self._sequence = {}
+        # Number of the next message added, never reused after a removal
+        self._next = 0
+        # Mapping id of the top container of a thread -> its pruned root
+        self._roots = {}
+        # Mapping id of the top container of a thread -> its sort key
+        self._keys = {}
+        # Mapping id -> set of ids of the messages referencing it
+        self._referrers = {}
+
+    @property
+    def roots(self):
+        return [self._roots[i] for i in sorted(self._roots, key=self._keys.get)]
+
+    def _top(self, container):
+        while container._parent is not None:
+            container = container._parent
+        return container
+
+    def _subtree(self, container):
+        stack = [container]
+        while stack:
+            container = stack.pop()
+            yield container
+            stack.extend(container.children)
+
+    def _pruned(self, top):
+        '''Get a pruned and sorted copy of the thread below `top`, None if empty'''
+        copies = {}
+        for container in self._subtree(top):
+            copy = copies[container] = Container(container._message)
+            if container is not top:
+                copy._parent = parent = copies[container._parent]
+                if parent._children is None:
+                    parent._children = [copy]
+                else:
+                    parent._children.append(copy)
+        root, = copies[top].prune()
+        if root.is_placeholder and not root._children:
+            return None
+        root._parent = None
+        dates = {}
+        sort_threads([root], dates)
+        self._keys[top.id] = _sort_key(root, dates)
+        return root
+
+    def _add(self, messages):
+        '''Add `messages` to the table, returns the ids of the containers touched'''
+        touched = set()
+        for message in messages:
+            if message.id not in self._sequence:
+                self._sequence[message.id] = self._next
+                self._next += 1
+            self._table.add_message(message)
+            touched.add(message.id)
+            touched.update(message.ref)
+            for ref in message.ref:
+                self._referrers.setdefault(ref, set()).add(message.id)
+            cooperate()
+        return touched
+
+    def _update(self, old, tops):
+        '''Replace the roots of the threads with top ids `old` by those of `tops`'''
+        before = {}
+        for top_id in old:
+            root = self._roots.pop(top_id, None)
+            self._keys.pop(top_id, None)
+            if root is not None:
+                before[root.id] = root
+        after = {}
+        for top in tops:
+            root = self._pruned(top)
+            if root is not None:
+                self._roots[top.id] = root
+                after[root.id] = root
+        return Diff(
+            [r for i, r in after.items() if i not in before],
+            [r for i, r in after.items() if i in before],
+            [i for i in before if i not in after]
+        )
+
+    def _tops(self, messages):
+        '''Get the tops of the threads holding the ids and refs of `messages`
+
+        Adding the messages can move these containers to another thread, so
+        the threads they are moved out of must be pruned again as well.
+        '''
+        tops = set()
+        for message in messages:
+            for i in (message.id,) + tuple(message.ref):
+                container = self._table.get(i)
+                if container is not None:
+                    tops.add(self._top(container))
+        return tops
+
+    def add_messages(self, messages):
+        messages = list(messages)
+        old = self._tops(messages)
+        touched = self._add(messages)
+        tops = set(self._top(self._table[i]) for i in touched)
+        tops.update(t for t in old if t._parent is None)
+        return self._update(touched.union(t.id for t in tops).union(t.id for t in old), tops)
+
+    def remove_messages(self, message_ids):
+        '''Remove messages, rebuilding the threads they were in
+
+        The threads sharing an id or a reference with the messages rebuilt
+        are rebuilt with them, so the result is the same as threading the
+        remaining messages from scratch.
+        '''
+        removed = set(i for i in message_ids if i in self._sequence)
+        pending = self._tops(self._table[i]._message for i in removed)
+        tops = set(pending)
+
+        remaining = []
+        while pending:
+            found = []
+            referrers = set()
+            for container in list(self._subtree(pending.pop())):
+                del self._table[container.id]
+                referrers.update(self._referrers.get(container.id, ()))
+                if container.id in removed:
+                    del self._sequence[container.id]
+                    for ref in set(container._message.ref):
+                        self._referrers[ref].discard(container.id)
+                        if not self._referrers[ref]:
+                            del self._referrers[ref]
+                elif not container.is_placeholder:
+                    found.append(container._message)
+            remaining.extend(found)
+            # The messages referencing a container rebuilt linked it too
+            more = self._tops(found)
+            more.update(self._top(self._table[i]) for i in referrers if i in self._table)
+            for top in more:
+                if top not in tops:
+                    tops.add(top)
+                    pending.add(top)
+        remaining.sort(key=lambda m: self._sequence[m.id])
+
+        touched = self._add(remaining)
+        new_tops = set(self._top(self._table[i]) for i in touched)
+        return self._update(
+            set(t.id for t in tops).union(t.id for t in new_tops),
+            new_tops)
@@ -1,52 +1,94 @@
+'''Thread the messages of maildirs
+
+The headers of each maildir are read and threaded in a pool of processes,
+one maildir per process at a time. With --merge the processes only read
+the maildirs and their tables are merged and threaded as one forest, so a
+reply kept in Sent joins its thread in INBOX.
+'''
 from __future__ import print_function
+import os
 import sys
+import argparse
+import mailbox
+from concurrent.futures import ProcessPoolExecutor
+
+from . import Container, Table, thread_table
+from .adapt import HeaderReader, read_maildir
+
+
+def read_folder(path):
+    '''Read the headers of the maildir at `path` into a `Table`'''
+    table = Table()
+    for message in read_maildir(HeaderReader(mailbox.Maildir(path, create=False))):
+        table.add_message(message)
+    print('done reading %s' % path, file=sys.stderr)
+    return table
+
+
+def read_folders(paths, jobs=None):
+    '''Get the `Table` of each maildir in `paths`, read in parallel'''
+    with ProcessPoolExecutor(jobs) as executor:
+        return list(executor.map(read_folder, paths))
+
+
+def _flatten(roots):
+    # Sent flat as deep threads would exceed the recursion limit when pickled
+    items = []
+    stack = [(r, None) for r in reversed(roots)]
+    while stack:
+        container, parent = stack.pop()
+        stack.extend((c, len(items)) for c in reversed(list(container.children)))
+        items.append((container._message, parent))
+    return items
+
+
+def _unflatten(items):
+    roots = []
+    containers = []
+    for message, parent in items:
+        container = Container(message)
+        containers.append(container)
+        if parent is None:
+            roots.append(container)
+        else:
+            containers[parent].add_child(container)
+    return roots
+
+
+def thread_folder(path):
+    '''Thread the maildir at `path`, returns the roots flattened'''
+    roots = thread_table(read_folder(path))
+    print('done threading %s' % path, file=sys.stderr)
+    return _flatten(roots)
+
+
+def thread_folders(paths, jobs=None):
+    '''Get the roots of each maildir in `paths`, threaded in parallel'''
+    with ProcessPoolExecutor(jobs) as executor:
+        return [_unflatten(items) for items in executor.map(thread_folder, paths)]
 
-try:
-    import gevent
-    spawn = gevent.spawn
-    joinall = gevent.joinall
-except ImportError:
-    # Mocked gevent
-    from collections import namedtuple
-    gevent = False
-    job = namedtuple('job', ('value'))
-    spawn = lambda f, *args, **kwargs: job(f(*args, **kwargs))
-    joinall = lambda jobs: None
 
 def main():
-    quit = False
-
-    def say(str):
-        while not quit:
-            print(str, file=sys.stderr)
-            gevent.sleep(1)
-
-    def thread_maildir(maildir):
-        threaded = thread(read_maildir(maildir))
-        print('done threading %s' % maildir._path, file=sys.stderr)
-        return threaded
-
-    import os.path
-    maildir = os.path.expanduser('~/Mail')
-
-    testboxes = [
-        '/home/davve/Mail/klarna/vacation.2012-mar',
-        '/home/davve/Mail/gmail/INBOX',
-    ]
-
-    import mailbox
-    from .adapt import read_maildir
-    from . import thread
-
-    if gevent:
-        spawn(say, 'tick')
-
-    maildirs = [mailbox.Maildir(box, create=False) for box in testboxes]
-    jobs = [spawn(thread_maildir, maildir) for maildir in maildirs]
-    joinall(jobs)
-    quit = True
-    for job in jobs:
-        for root in job.value:
+    parser = argparse.ArgumentParser(prog='threader', description=__doc__.split('\n')[0])
+    parser.add_argument('maildirs', nargs='*', metavar='MAILDIR',
+                        default=[os.path.expanduser('~/Mail/INBOX')])
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of processes, defaults to the number of cores')
+    parser.add_argument('--merge', action='store_true',
+                        help='Merge the threads of all maildirs')
+    args = parser.parse_args()
+
+    if args.merge:
+        tables = read_folders(args.maildirs, args.jobs)
+        merged = tables[0]
+        for table in tables[1:]:
+            merged.merge(table)
+        forests = [thread_table(merged)]
+    else:
+        forests = thread_folders(args.maildirs, args.jobs)
+
+    for roots in forests:
+        for root in roots:
             root.dump()
 
 
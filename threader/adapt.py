@@ -1,5 +1,7 @@
 from . import message
+import os.path
 import re
+from mcache import parse_date, read_headers
 
 _message_id = re.compile('(<[^>]+>)')
 def extract_references(mail):
@@ -31,5 +33,23 @@ def read_maildir(maildir):
         yield message(
             id=message_id,
             subject=subject,
-            ref=references
+            ref=references,
+            date=parse_date(mail['Date'])
         )
+
+
+class HeaderReader(object):
+    '''Iterate the headers of the messages in a maildir without the bodies'''
+
+    def __init__(self, maildir):
+        self._maildir = maildir
+
+    def __iter__(self):
+        for key in self._maildir.keys():
+            try:
+                path = os.path.join(self._maildir._path, self._maildir._lookup(key))
+            except KeyError:
+                continue
+            headers = read_headers(path)
+            if headers is not None:
+                yield headers
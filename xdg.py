@@ -16,6 +16,10 @@ class Context(object):
             'XDG_CACHE_HOME',
             os.path.join(self.home, '.cache')
         )
+        self.runtime_home = os.environ.get(
+            'XDG_RUNTIME_DIR',
+            self.cache_home
+        )
 
     def config(self, *path):
         return os.path.join(self.config_home, self._app, *path)
@@ -25,3 +29,6 @@ class Context(object):
 
     def cache(self, *path):
         return os.path.join(self.cache_home, self._app, *path)
+
+    def runtime(self, *path):
+        return os.path.join(self.runtime_home, self._app, *path)